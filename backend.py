@@ -0,0 +1,358 @@
+#!/usr/bin/python2
+
+import os
+import json
+import time
+import random
+import logging
+
+from threading import Lock
+from auth import AuthManager
+from apiclient import errors as apierrors
+from apiclient.discovery import build as build_service
+from apiclient.http import MediaInMemoryUpload
+
+logger = logging.getLogger('gbd')
+
+class RateLimitError(Exception):
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+class Backend:
+
+    ## interface
+
+    def clone(self):
+        raise NotImplementedError()
+
+    def read(self, blkid, offset=0, length=None):
+        # length bytes from offset, the rest of the file if None
+        raise NotImplementedError()
+
+    def write(self, blkid, data):
+        raise NotImplementedError()
+
+    def allocate(self, name, data, mimetype=None):
+        raise NotImplementedError()
+
+    def allocate_many(self, name, count):
+        # Empty block files, as many of count as could be created
+        raise NotImplementedError()
+
+    def claim(self, blkid, name, data):
+        # Fill in a file from allocate_many() and rename it, returns its id
+        raise NotImplementedError()
+
+    def delete(self, blkid):
+        raise NotImplementedError()
+
+    def find(self, name):
+        raise NotImplementedError()
+
+    def list(self):
+        raise NotImplementedError()
+
+class DriveBackend(Backend):
+
+    FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+    BLOCK_MIMETYPE = 'application/octet-stream'
+
+    RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+    # Bigger files go up in chunks, a chunk that fails is sent again
+    # instead of the whole file
+    RESUMABLE_SIZE = 5 << 20
+    CHUNK_SIZE = 4 << 20
+    CHUNK_TRIES = 5
+
+    def __init__(self, config, auth_mgr=None, data_dir=None):
+
+        self.config = config
+        if auth_mgr is None:
+            auth_mgr = AuthManager(
+                self.config['appname'],
+                self.config['oauth_client_id'],
+                self.config['oauth_client_secret'],
+                self.config['oauth_scope'],
+                self.config['oauth_redirect_uri'])
+        self.auth_mgr = auth_mgr
+        self.drive = build_service('drive', 'v2', http=self.auth_mgr.get_auth_http())
+
+        if data_dir is None:
+            data_dir = self.get_data_dir()
+        self.data_dir = data_dir
+        self.location = data_dir
+
+    ## init
+
+    def get_data_dir(self):
+
+        folder = self.config['gbd_data_folder']
+        query_str = "title='{0}'".format(folder)
+
+        results = self.drive.files().list(q=query_str).execute()
+        items = filter(lambda x: not x['labels']['trashed'], results['items'])
+        if len(items) == 0:
+            if not self.config.get('create', False):
+                raise RuntimeError("Can't locate `{0}'".format(folder))
+            else:
+                return self.create_data_dir()
+        if len(items) > 1:
+            raise AssertionError("{0} results found for `{1}', don't know which to use".format(len(items), folder))
+
+        item = items[0]
+        if item['mimeType'] != self.FOLDER_MIMETYPE:
+            raise AssertionError("`{0}' is not a folder!! (mimeType={1})".format(folder, item['mimeType']))
+        if not item['editable']:
+            raise RuntimeError("folder `{0}' is readonly!".format(folder))
+
+        return item['id']
+
+    def create_data_dir(self):
+
+        folder = self.config['gbd_data_folder']
+        body = {
+            'title': folder,
+            'parents': ['root'],
+            'mimeType': self.FOLDER_MIMETYPE,
+        }
+        result = self.drive.files().insert(body=body).execute()
+
+        if not result:
+            raise RuntimeError("Can't create folder `{0}'".format(folder))
+        return result['id']
+
+    ## interface
+
+    def clone(self):
+        return DriveBackend(self.config, self.auth_mgr, self.data_dir)
+
+    def read(self, blkid, offset=0, length=None):
+        request = self.drive.files().get_media(fileId=blkid)
+        if offset or length is not None:
+            end = '' if length is None else offset + length - 1
+            request.headers['Range'] = 'bytes={0}-{1}'.format(offset, end)
+        return self.execute(request)
+
+    def write(self, blkid, data):
+        media_body = self.media(data)
+        self.execute(self.drive.files().update(fileId=blkid, media_body=media_body))
+
+    def allocate(self, name, data, mimetype=None):
+        mimetype = mimetype or self.BLOCK_MIMETYPE
+        body = {
+            'title': name,
+            'mimeType': mimetype,
+            'parents': [{'id': self.data_dir}],
+        }
+        media_body = self.media(data, mimetype)
+        return self.execute(self.drive.files().insert(body=body, media_body=media_body))['id']
+
+    def allocate_many(self, name, count):
+        body = {
+            'title': name,
+            'mimeType': self.BLOCK_MIMETYPE,
+            'parents': [{'id': self.data_dir}],
+        }
+        blkids = []
+        errors = []
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                blkids.append(response['id'])
+        batch = self.drive.new_batch_http_request(callback=callback)
+        for i in xrange(count):
+            batch.add(self.drive.files().insert(body=dict(body), fields='id'))
+        self.execute(batch)
+        if errors and not blkids:
+            raise self.convert(errors[0])
+        return blkids
+
+    def claim(self, blkid, name, data):
+        media_body = self.media(data)
+        self.execute(self.drive.files().update(fileId=blkid, body={'title': name}, media_body=media_body))
+        return blkid
+
+    def delete(self, blkid):
+        self.execute(self.drive.files().delete(fileId=blkid))
+
+    def find(self, name):
+        # Index deltas all share a name, there can be more than a page of them
+        query_str = "title='{0}'".format(name)
+        ids = []
+        page_token = None
+        while True:
+            results = self.execute(self.drive.children().list(folderId=self.data_dir, q=query_str, maxResults=1000, pageToken=page_token))
+            ids.extend(item['id'] for item in results['items'])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return ids
+
+    def list(self):
+        query_str = "'{0}' in parents and trashed=false".format(self.data_dir)
+        fields = 'nextPageToken,items(id,title)'
+        page_token = None
+        while True:
+            results = self.execute(self.drive.files().list(q=query_str, fields=fields, maxResults=1000, pageToken=page_token))
+            for item in results['items']:
+                yield item['title'], item['id']
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    ## helper
+
+    def media(self, data, mimetype=None):
+        mimetype = mimetype or self.BLOCK_MIMETYPE
+        if len(data) > self.RESUMABLE_SIZE:
+            return MediaInMemoryUpload(data, mimetype=mimetype, chunksize=self.CHUNK_SIZE, resumable=True)
+        return MediaInMemoryUpload(data, mimetype=mimetype, resumable=False)
+
+    def execute(self, request):
+        if getattr(request, 'resumable', None) is not None:
+            return self.upload(request)
+        try:
+            return request.execute()
+        except apierrors.HttpError as e:
+            raise self.convert(e)
+
+    def upload(self, request):
+        # After a failed chunk next_chunk() asks drive what it got and
+        # carries on from there
+        tries = 0
+        response = None
+        while response is None:
+            try:
+                _, response = request.next_chunk()
+                tries = 0
+            except apierrors.HttpError as e:
+                e = self.convert(e)
+                tries += 1
+                if not isinstance(e, RateLimitError) or tries == self.CHUNK_TRIES:
+                    raise e
+                time.sleep(2 ** tries)
+        return response
+
+    def convert(self, e):
+        if not isinstance(e, apierrors.HttpError):
+            return e
+        if e.resp.status == 403:
+            reason = json.loads(e.content)['error']['errors'][0]['reason']
+            if reason in self.RATE_LIMIT_REASONS:
+                return RateLimitError(reason)
+        # Too many requests, or drive having trouble keeping up
+        if e.resp.status == 429 or e.resp.status >= 500:
+            return RateLimitError("http {0}".format(e.resp.status))
+        return e
+
+class LocalBackend(Backend):
+
+    def __init__(self, config):
+
+        self.config = config
+        self.path = os.path.abspath(self.config.get('local_path', self.config['gbd_data_folder']))
+        self.latency = float(self.config.get('local_latency', 0))
+        self.jitter = float(self.config.get('local_jitter', 0))
+        self.rate_limit = float(self.config.get('local_rate_limit', 0))
+        self.location = self.path
+
+        self.tokens = self.rate_limit
+        self.last_refill = time.time()
+        self.throttled = 0
+        self.serial = 0
+        self.allocating = set()
+        self.lock = Lock()
+
+        if not os.path.isdir(self.path):
+            if not self.config.get('create', False):
+                raise RuntimeError("Can't locate `{0}'".format(self.path))
+            os.makedirs(self.path)
+
+    ## interface
+
+    def clone(self):
+        return self
+
+    def read(self, blkid, offset=0, length=None):
+        self.delay()
+        with open(self.file_path(blkid), 'rb') as fin:
+            fin.seek(offset)
+            return fin.read() if length is None else fin.read(length)
+
+    def write(self, blkid, data):
+        self.delay()
+        tmp_path = self.file_path(blkid) + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            fout.write(data)
+        os.rename(tmp_path, self.file_path(blkid))
+
+    def allocate(self, name, data, mimetype=None):
+        # Like drive, several files may share a name
+        blkid = name
+        with self.lock:
+            while os.path.exists(self.file_path(blkid)) or blkid in self.allocating:
+                self.serial += 1
+                blkid = "{0}~{1}".format(name, self.serial)
+            self.allocating.add(blkid)
+        try:
+            self.write(blkid, data)
+        finally:
+            with self.lock:
+                self.allocating.remove(blkid)
+        return blkid
+
+    def allocate_many(self, name, count):
+        # One round trip for the lot, like a drive batch
+        self.delay()
+        blkids = []
+        with self.lock:
+            for i in xrange(count):
+                blkid = name
+                while os.path.exists(self.file_path(blkid)) or blkid in self.allocating:
+                    self.serial += 1
+                    blkid = "{0}~{1}".format(name, self.serial)
+                open(self.file_path(blkid), 'wb').close()
+                blkids.append(blkid)
+        return blkids
+
+    def claim(self, blkid, name, data):
+        # Ids are file names here, so the block gets a new one
+        new_blkid = self.allocate(name, data)
+        os.unlink(self.file_path(blkid))
+        return new_blkid
+
+    def delete(self, blkid):
+        self.delay()
+        os.unlink(self.file_path(blkid))
+
+    def find(self, name):
+        self.delay()
+        return [blkid for blkid in os.listdir(self.path) if blkid.split('~')[0] == name and not blkid.endswith('.tmp')]
+
+    def list(self):
+        self.delay()
+        for name in os.listdir(self.path):
+            if not name.endswith('.tmp'):
+                yield name.split('~')[0], name
+
+    ## helper
+
+    def file_path(self, blkid):
+        return os.path.join(self.path, blkid)
+
+    def delay(self):
+        if self.rate_limit > 0:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+                self.last_refill = now
+                if self.tokens < 1:
+                    self.throttled += 1
+                    raise RateLimitError('rateLimitExceeded')
+                self.tokens -= 1
+        to_sleep = self.latency + random.uniform(0, self.jitter)
+        if to_sleep > 0:
+            time.sleep(to_sleep)
@@ -0,0 +1,345 @@
+#!/usr/bin/python2
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import random
+import bisect
+import logging
+import argparse
+import tempfile
+from threading import Thread, Lock, Semaphore
+from cached_gbd import CachedGBD
+from nbd import NBDService
+from policy import POLICIES
+from tracing import TRACER
+
+logger = logging.getLogger('gbd')
+
+## workloads
+
+class Workload:
+
+    def __init__(self, name, size, io_size, count, read_ratio, seed, zipf_theta=None, sequential=False, scan_ratio=0.0):
+        self.name = name
+        self.size = size
+        self.io_size = io_size
+        self.count = count
+        self.read_ratio = read_ratio
+        self.seed = seed
+        self.sequential = sequential
+        # Share of the operations that belong to a read pass over the whole device
+        self.scan_ratio = scan_ratio
+        self.slots = size // io_size
+        self.cdf = None
+        if zipf_theta is not None:
+            self.build_zipf(zipf_theta)
+
+    def build_zipf(self, theta):
+        total = 0.0
+        self.cdf = []
+        for rank in xrange(1, self.slots + 1):
+            total += 1.0 / (rank ** theta)
+            self.cdf.append(total)
+        self.cdf = [x / total for x in self.cdf]
+        self.perm = range(self.slots)
+        random.Random(self.seed).shuffle(self.perm)
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        scan = 0
+        for i in xrange(self.count):
+            if self.scan_ratio and rng.random() < self.scan_ratio:
+                yield False, scan * self.io_size, self.io_size
+                scan = (scan + 1) % self.slots
+                continue
+            if self.sequential:
+                slot = i % self.slots
+            elif self.cdf is not None:
+                slot = self.perm[bisect.bisect_left(self.cdf, rng.random())]
+            else:
+                slot = rng.randrange(self.slots)
+            is_write = rng.random() >= self.read_ratio
+            yield is_write, slot * self.io_size, self.io_size
+
+class TraceWorkload:
+
+    NBD_REQ_MAGIC = 0x25609513
+    HEADER = struct.Struct("!IIQQI")
+
+    def __init__(self, path):
+        self.name = 'replay:' + os.path.basename(path)
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as fin:
+            while True:
+                header = fin.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    break
+                magic, type, _, offset, length = self.HEADER.unpack(header)
+                assert magic == self.NBD_REQ_MAGIC
+                cmd = type & NBDService.NBD_REQ_MASK
+                if cmd == NBDService.NBD_CMD_WRITE:
+                    fin.seek(length, os.SEEK_CUR)
+                    yield True, offset, length
+                elif cmd == NBDService.NBD_CMD_READ:
+                    yield False, offset, length
+
+def build_workloads(args):
+    count = args.ops
+    size = args.size
+    bs = args.io_size
+    return {
+        'seqread': Workload('seqread', size, args.seq_size, count, 1.0, args.seed, sequential=True),
+        'seqwrite': Workload('seqwrite', size, args.seq_size, count, 0.0, args.seed, sequential=True),
+        'randread': Workload('randread', size, bs, count, 1.0, args.seed),
+        'randwrite': Workload('randwrite', size, bs, count, 0.0, args.seed),
+        'mixed': Workload('mixed', size, bs, count, args.read_ratio, args.seed),
+        'zipf': Workload('zipf', size, bs, count, args.read_ratio, args.seed, zipf_theta=args.zipf_theta),
+        'zipfscan': Workload('zipfscan', size, bs, count, args.read_ratio, args.seed, zipf_theta=args.zipf_theta, scan_ratio=args.scan_ratio),
+    }
+
+## drivers
+
+class CachedDriver:
+
+    def __init__(self, gbd):
+        self.gbd = gbd
+
+    def submit(self, is_write, offset, length, payload, done):
+        if is_write:
+            self.gbd.write(offset, payload[:length], callback=lambda err: done(err))
+        else:
+            self.gbd.read(offset, length, callback=lambda err, data: done(err))
+
+    def close(self):
+        pass
+
+class NBDDriver:
+
+    def __init__(self, gbd):
+        self.gbd = gbd
+        self.sock, server_sock = socket.socketpair()
+        self.server = Thread(target=NBDService(server_sock, gbd).serve)
+        self.server.daemon = True
+        self.server.start()
+
+        self.lock = Lock()
+        self.handle = 0
+        self.pending = {}
+        self.reader = Thread(target=self.read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def submit(self, is_write, offset, length, payload, done):
+        with self.lock:
+            self.handle += 1
+            handle = self.handle
+            self.pending[handle] = (0 if is_write else length, done)
+            cmd = NBDService.NBD_CMD_WRITE if is_write else NBDService.NBD_CMD_READ
+            self.sock.sendall(NBDService.NBD_REQ_MAGIC + struct.pack("!IQQI", cmd, handle, offset, length))
+            if is_write:
+                self.sock.sendall(payload[:length])
+
+    def read_replies(self):
+        while True:
+            reply = self.sock.recv(16, socket.MSG_WAITALL)
+            if len(reply) < 16:
+                break
+            assert reply[:4] == NBDService.NBD_RPY_MAGIC
+            error, handle = struct.unpack("!IQ", reply[4:])
+            with self.lock:
+                length, done = self.pending.pop(handle)
+            if length and not error:
+                self.sock.recv(length, socket.MSG_WAITALL)
+            done(IOError(error) if error else None)
+
+    def close(self):
+        self.sock.sendall(NBDService.NBD_REQ_MAGIC + struct.pack("!IQQI", NBDService.NBD_CMD_DISC, 0, 0, 0))
+        self.server.join()
+        # Wakes the reader up before the socket goes away under it
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.reader.join()
+        self.sock.close()
+
+## runner
+
+class Stats:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latency = []
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, err, latency, length):
+        with self.lock:
+            if err:
+                self.errors += 1
+            else:
+                self.latency.append(latency)
+                self.bytes += length
+
+    def percentile(self, p):
+        if not self.latency:
+            return 0.0
+        lat = sorted(self.latency)
+        return lat[min(len(lat) - 1, int(len(lat) * p / 100.0))]
+
+def run_workload(args, workload, mode):
+
+    workdir = tempfile.mkdtemp(prefix='gbd-bench-')
+    try:
+        cache_file = os.path.join(workdir, 'cache')
+        with open(cache_file, 'wb') as fout:
+            fout.truncate(args.cache_size)
+
+        gbd = CachedGBD(
+            cache_file=cache_file,
+            backend='local',
+            create=True,
+            gbd_data_folder='bench',
+            local_path=os.path.join(workdir, 'store'),
+            local_latency=args.latency,
+            local_jitter=args.jitter,
+            local_rate_limit=args.rate_limit,
+            default_block_size=args.block_size,
+            default_total_size=args.size,
+            workers=args.workers,
+            pull_workers=args.pull_workers,
+            readahead=args.readahead,
+            spare_blocks=args.spare_blocks,
+            default_layout=args.layout,
+            bypass=args.bypass,
+            policy=args.policy)
+        if args.prefill:
+            prefill(gbd.gbd)
+        driver = NBDDriver(gbd) if mode == 'nbd' else CachedDriver(gbd)
+
+        payload = os.urandom(max(args.io_size, args.seq_size))
+        stats = Stats()
+        sem = Semaphore(args.iodepth)
+
+        hits, misses, ghost_hits = gbd.hits, gbd.misses, gbd.clean_que.ghost_hits
+        start = time.time()
+        for is_write, offset, length in workload:
+            if len(payload) < length:
+                payload = os.urandom(length)
+            sem.acquire()
+            def gdone(issued, length):
+                def done(err):
+                    stats.record(err, time.time() - issued, length)
+                    sem.release()
+                return done
+            driver.submit(is_write, offset, length, payload, gdone(time.time(), length))
+        for i in xrange(args.iodepth):
+            sem.acquire()
+        elapsed = time.time() - start
+        hits, misses = gbd.hits - hits, gbd.misses - misses
+        ghost_hits = gbd.clean_que.ghost_hits - ghost_hits
+
+        sync_start = time.time()
+        driver.close()
+        gbd.end()
+        sync_time = time.time() - sync_start
+
+        ops = len(stats.latency)
+        return {
+            'workload': workload.name,
+            'mode': mode,
+            'policy': args.policy,
+            'layout': args.layout,
+            'ops': ops,
+            'errors': stats.errors,
+            'iops': ops / elapsed,
+            'mbps': stats.bytes / elapsed / (1 << 20),
+            'p50_ms': stats.percentile(50) * 1000,
+            'p99_ms': stats.percentile(99) * 1000,
+            'hit_ratio': float(hits) / (hits + misses) if hits + misses else 0.0,
+            'ghost_hits': ghost_hits,
+            'throttled': gbd.gbd.backend.throttled,
+            'sync_s': sync_time,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def prefill(gbd):
+    # Unwritten blocks never reach the store, so give reads something to fetch
+    block = os.urandom(gbd.block_size)
+    for idx in xrange(gbd.block_count):
+        gbd.write_block(idx, block, cb=lambda err, ret: None)
+    gbd.sync()
+
+def print_report(results):
+    fmt = "{workload:<16} {mode:<6} {ops:>8} {errors:>6} {iops:>10.1f} {mbps:>9.2f} {p50_ms:>9.2f} {p99_ms:>9.2f} {hit_ratio:>6.3f} {ghost_hits:>6} {throttled:>9} {sync_s:>7.2f}"
+    print "{0:<16} {1:<6} {2:>8} {3:>6} {4:>10} {5:>9} {6:>9} {7:>9} {8:>6} {9:>6} {10:>9} {11:>7}".format(
+        'workload', 'mode', 'ops', 'errors', 'iops', 'MB/s', 'p50(ms)', 'p99(ms)', 'hit', 'ghost', 'throttled', 'sync(s)')
+    for result in results:
+        print fmt.format(**result)
+
+def parse_size(value):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if value[-1].upper() in units:
+        return int(value[:-1]) * units[value[-1].upper()]
+    return int(value)
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Benchmark CachedGBD and the NBD server against a local block store')
+    parser.add_argument('-w', '--workload', action='append', help='seqread, seqwrite, randread, randwrite, mixed, zipf or zipfscan (default: all)')
+    parser.add_argument('-r', '--replay', action='append', default=[], help='replay a recorded NBD request stream')
+    parser.add_argument('-m', '--mode', action='append', choices=['cached', 'nbd'], help='layer to drive (default: both)')
+    parser.add_argument('--block-size', type=parse_size, default=parse_size('64K'))
+    parser.add_argument('--size', type=parse_size, default=parse_size('64M'))
+    parser.add_argument('--cache-size', type=parse_size, default=parse_size('16M'))
+    parser.add_argument('--io-size', type=parse_size, default=parse_size('4K'))
+    parser.add_argument('--seq-size', type=parse_size, default=parse_size('128K'))
+    parser.add_argument('--ops', type=int, default=2000)
+    parser.add_argument('--iodepth', type=int, default=16)
+    parser.add_argument('--read-ratio', type=float, default=0.7)
+    parser.add_argument('--zipf-theta', type=float, default=0.99)
+    parser.add_argument('--scan-ratio', type=float, default=0.5, help='share of zipfscan operations that scan the device')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--pull-workers', type=int, default=4)
+    parser.add_argument('--readahead', type=int, default=32, help='maximum readahead window in blocks (0: off)')
+    parser.add_argument('--layout', choices=['block', 'cas', 'log'], default='block', help='how blocks are stored')
+    parser.add_argument('--spare-blocks', type=int, default=100, help='empty block files kept ready for first writes (0: off)')
+    parser.add_argument('--no-bypass', dest='bypass', action='store_false', help='cache every block read, even small cold reads')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='lru', help='cache replacement policy')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every block store request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency in seconds')
+    parser.add_argument('--rate-limit', type=float, default=0, help='block store requests per second (0: unlimited)')
+    parser.add_argument('--no-prefill', dest='prefill', action='store_false', help="don't write the whole store before running")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', help='write a chrome trace of the nbd requests to this file')
+    parser.add_argument('--trace-rate', type=float, default=1.0, help='share of the requests to trace')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args(argv)
+
+    workloads = build_workloads(args)
+    names = args.workload or ([] if args.replay else sorted(workloads))
+    selected = [workloads[name] for name in names] + [TraceWorkload(path) for path in args.replay]
+
+    if args.trace:
+        TRACER.open(args.trace, args.trace_rate)
+    results = []
+    for mode in args.mode or ['cached', 'nbd']:
+        for workload in selected:
+            results.append(run_workload(args, workload, mode))
+    TRACER.close()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+
+    logging.basicConfig()
+    logger.setLevel(logging.WARNING)
+    main(sys.argv[1:])
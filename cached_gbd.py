@@ -1,11 +1,20 @@
 import os
+import re
+import mmap
+import ctypes
 import struct
+import itertools
 import hashlib
 import time
 import logging
-from threading import Thread, Lock, Condition, Semaphore
-from Queue import Queue
-from util import TimedPriorityQueue, RLUQueue
+from collections import OrderedDict
+from threading import Thread, Lock, Condition, Semaphore, Event
+from util import DeadlineQueue, RLUQueue
+from readahead import Readahead
+from journal import Journal
+from policy import POLICIES
+from config import Config
+from metrics import REGISTRY
 from gbd import GBD
 
 logger = logging.getLogger('gbd')
@@ -13,8 +22,19 @@ logger = logging.getLogger('gbd')
 class CachedGBD:
 
     EMPTY = 0xffffffffffffffff
+    DIRTY = 1 << 63
+    STRIPES = 64
+    SECTOR = 512
 
-    def __init__(self, cache_file, dirty=False, *args, **kargs):
+    # Journal records between checkpoints
+    JOURNAL_LIMIT = 1 << 16
+
+    # Reads wanting at most this share of a block are small, reads of at
+    # least BYPASS_SCAN bytes are scans
+    BYPASS_SHARE = 0.25
+    BYPASS_SCAN = 1 << 20
+
+    def __init__(self, cache_file, dirty=False, pull_workers=4, readahead=32, policy=None, bypass=None, *args, **kargs):
 
         if 'workers' not in kargs:
             kargs['workers'] = 16
@@ -22,33 +42,83 @@ class CachedGBD:
         self.done = False
 
         self.gbd = GBD(*args, **kargs)
+        self.name = self.gbd.name
         self.uuid = self.gbd.uuid
         self.block_size = self.gbd.block_size
         self.block_count = self.gbd.block_count
         self.total_size = self.gbd.total_size
+        self.sector_size = self.SECTOR if self.block_size % self.SECTOR == 0 else self.block_size
+        self.full_mask = (1 << (self.block_size // self.sector_size)) - 1
 
-        self.cache = open(cache_file, 'r+b')
-        self.cache_lock = Lock()
+        self.cache_file = open(cache_file, 'r+b')
+        self.cache = mmap.mmap(self.cache_file.fileno(), 0)
+        # mmap only takes str on python2, this lets any buffer be copied in and out
+        self.view = memoryview((ctypes.c_char * len(self.cache)).from_buffer(self.cache))
         self.entry_count = self.calc_entry_count()
-        self.clean_que = RLUQueue(self.entry_count)
+        # Clean entries that may be evicted, dirty ones become evictable
+        # once written back
+        self.clean_que = POLICIES[policy or Config.get('cache_policy', 'lru')](self.entry_count)
         self.dirty_que = RLUQueue(self.entry_count)
         self.last_modify = [0] * self.entry_count
+        self.digest = [None] * self.entry_count
+        # Bitmap of sectors holding real data, partial writes to blocks we
+        # don't have leave the rest to be fetched on demand
+        self.valid = [0] * self.entry_count
         self.map = {}
         self.rmap = [self.EMPTY] * self.entry_count
-        self.map_lock = Lock()
-        self.load_cache(dirty)
-
-        self.wb_sem = Semaphore(8)
+        # idx => requests waiting for the thread that holds idx's entry
+        self.busy = {}
+        # idx => requests on their way to dispatch()
+        self.queued = {}
+        self.locks = [Lock() for i in xrange(self.STRIPES)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pushed = 0
+        self.bypassed = 0
+
+        # Blocks read around the cache lately, those read again are cached
+        self.bypass = Config.get('cache_bypass', True) if bypass is None else bypass
+        self.bypass_seen = OrderedDict()
+        self.bypass_lock = Lock()
+
+        # Entries written since they were last pushed. A flush waits for
+        # the ones dirty when it came in and nothing else, writes after it
+        # don't hold it up.
+        self.cv = Condition()
+        self.unflushed = set()
+        self.urgent = set()
+        self.flushes = []
+        self.flush_seq = 0
+        self.inflight = 0
+
+        nsect = self.block_size // self.sector_size
+        self.journal = Journal(cache_file + '.journal', self.uuid, (nsect + 7) // 8)
+        # The journal may call blocks clean the stale index never got to
+        self.load_cache(dirty or self.gbd.layout.INDEX_ONLY and self.gbd.stale_index)
+
+        self.readahead = Readahead(self.block_count, readahead) if readahead > 0 else None
+
+        self.running = True
+        self.cp_event = Event()
+        self.cp_daemon = Thread(target=self.do_checkpoint)
+        self.cp_daemon.daemon = True
+        self.cp_daemon.start()
+
+        self.wb_sem = Semaphore(self.gbd.layout.write_depth)
         self.wb_daemon = Thread(target=self.do_writeback)
         self.wb_daemon.daemon = True
         self.wb_daemon.start()
 
-        self.pull_que = TimedPriorityQueue()
-        self.dque_lock = Lock()
-        self.pull_delay_que = {}
-        self.pull_daemon = Thread(target=self.do_pull)
-        self.pull_daemon.daemon = True
-        self.pull_daemon.start()
+        self.pull_que = DeadlineQueue()
+        self.pull_daemons = []
+        for i in xrange(pull_workers):
+            pull_daemon = Thread(target=self.do_pull)
+            pull_daemon.daemon = True
+            pull_daemon.start()
+            self.pull_daemons.append(pull_daemon)
+
+        self.init_metrics()
 
         self.done = True
 
@@ -56,92 +126,181 @@ class CachedGBD:
 
     def load_cache(self, dirty=True):
 
-        self.cache.seek(0, os.SEEK_SET)
-        cache_uuid = self.cache.read(len(self.uuid))
+        cache_uuid = self.cache[:len(self.uuid)]
         if cache_uuid == "\0" * len(self.uuid):
             logger.info("The cache file is empty, not loading anything")
-            for i in xrange(self.entry_count):
-                self.clean_que.put(i)
+            self.clean_que.extend(xrange(self.entry_count))
+            self.checkpoint()
             return
         if cache_uuid != self.uuid:
             raise AssertionError("It's not the correct cache device. (uuid mismatch)")
 
-        self.cache.seek(len(self.uuid), os.SEEK_SET)
-        record = self.cache.read(8 * self.entry_count)
-        for i in xrange(0, self.entry_count):
-            entry = struct.unpack("!Q", record[i*8:i*8+8])[0]
-            if entry != self.EMPTY:
-                assert entry < self.block_count and entry not in self.map
-                self.map[entry] = i
-                self.rmap[i] = entry
-                if dirty:
-                    self.dirty_que.put(i)
-                else:
-                    self.clean_que.put(i)
-                logger.debug("Map {0} => {1}".format(entry, i))
-            else:
-                self.clean_que.put(i)
+        # The map saved by the last checkpoint, the high bit marks dirty entries
+        record = struct.unpack_from("!%dQ" % self.entry_count, self.cache, len(self.uuid))
+        rmap = [self.EMPTY if ent == self.EMPTY else ent & ~self.DIRTY for ent in record]
+        dirties = set(i for i, ent in enumerate(record) if ent != self.EMPTY and ent & self.DIRTY)
+        owner = dict(itertools.izip(rmap, itertools.count()))
+        owner.pop(self.EMPTY, None)
+        if len(owner) != self.entry_count - rmap.count(self.EMPTY):
+            raise AssertionError("Block mapped to more than one cache entry")
+
+        # Entries not mentioned here are fully valid
+        valid = {}
+
+        def unmap(ent):
+            if rmap[ent] != self.EMPTY and owner.get(rmap[ent]) == ent:
+                del owner[rmap[ent]]
+            rmap[ent] = self.EMPTY
+            dirties.discard(ent)
+            valid.pop(ent, None)
+
+        count = 0
+        for op, ent, idx, mask in self.journal.replay():
+            count += 1
+            if op == Journal.OP_MAP:
+                unmap(ent)
+                if idx in owner:
+                    # Its entry was evicted, the record for that came later
+                    unmap(owner[idx])
+                rmap[ent] = idx
+                owner[idx] = ent
+                valid[ent] = 0
+            elif op == Journal.OP_UNMAP:
+                unmap(ent)
+            elif rmap[ent] != idx:
+                logger.warning("Journal record for {0} doesn't match entry {1}, skipped".format(idx, ent))
+            elif op == Journal.OP_DIRTY:
+                dirties.add(ent)
+            elif op == Journal.OP_CLEAN:
+                dirties.discard(ent)
+            elif op == Journal.OP_VALID:
+                valid[ent] = mask
+        if count:
+            logger.info("Replayed {0} journal records".format(count))
+
+        # Nothing worth keeping in there
+        for ent, mask in valid.items():
+            if mask == 0:
+                unmap(ent)
+
+        if owner and max(owner) >= self.block_count:
+            raise AssertionError("Cache entry out of bound")
+        self.rmap = rmap
+        self.map = owner
+        self.valid = [0 if idx == self.EMPTY else valid.get(ent, self.full_mask) for ent, idx in enumerate(rmap)]
+        if dirty:
+            dirties = set(owner.itervalues())
+        logger.info("Loaded {0} cache entries, {1} dirty".format(len(owner), len(dirties)))
+
+        # Digests are looked up when the entry is pushed
+        self.unflushed = set(dirties)
+        self.dirty_que.extend(sorted(dirties))
+        cleans = [ent for ent in xrange(self.entry_count) if ent not in dirties and rmap[ent] != self.EMPTY]
+        self.clean_que.extend(ent for ent in xrange(self.entry_count) if rmap[ent] == self.EMPTY)
+        self.clean_que.extend(cleans, [rmap[ent] for ent in cleans])
+
+        self.checkpoint()
+
+    def init_metrics(self):
+
+        # Read from our own counters when scraped, nothing to do on the I/O path
+        self.tracked = [
+            (REGISTRY.counter('gbd_cache_hits_total', 'Block lookups served from the cache', ('device',)), {}, lambda: self.hits),
+            (REGISTRY.counter('gbd_cache_misses_total', 'Block lookups that needed a cache entry', ('device',)), {}, lambda: self.misses),
+            (REGISTRY.counter('gbd_cache_ghost_hits_total', 'Misses on blocks the replacement policy evicted recently', ('device',)), {}, lambda: self.clean_que.ghost_hits),
+            (REGISTRY.counter('gbd_cache_bypassed_total', 'Block reads served straight from the store', ('device',)), {}, lambda: self.bypassed),
+            (REGISTRY.counter('gbd_cache_evictions_total', 'Blocks dropped from the cache to make room', ('device',)), {}, lambda: self.evictions),
+            (REGISTRY.counter('gbd_writeback_bytes_total', 'Bytes written back to the store', ('device',)), {}, lambda: self.pushed * self.block_size),
+            (REGISTRY.gauge('gbd_cache_dirty_entries', 'Cache entries not written back yet', ('device',)), {}, lambda: len(self.unflushed)),
+        ]
+        depth = REGISTRY.gauge('gbd_queue_depth', 'Requests waiting in a queue', ('device', 'queue'))
+        for queue, fn in [('pull', self.pull_que.qsize), ('dirty', self.dirty_que.__len__), ('evictable', self.clean_que.__len__)]:
+            self.tracked.append((depth, {'queue': queue}, fn))
+
+        for metric, labels, fn in self.tracked:
+            metric.track(fn, device=self.name, **labels)
 
     ## interface
 
-    def read(self, offset, length, callback=None):
+    def read(self, offset, length, callback=None, buf=None, trace=None):
 
         assert 0 <= offset < offset + length <= self.total_size
 
         idxl = offset // self.block_size
         idxr = (offset + length - 1) // self.block_size
 
+        # Blocks are copied straight from the cache into buf
+        if buf is None:
+            buf = bytearray(length)
+        assert len(buf) == length
+        out = memoryview(buf)
+
         cv = Condition()
         state = [idxr + 1 - idxl, None]
-        data_list = [None] * state[0]
+
+        def finish(err):
+            with cv:
+                if state[1] is not None:
+                    return
+                if err:
+                    state[1] = err
+                    if callback:
+                        callback(err, None)
+                    else:
+                        cv.notify()
+                    return
+                state[0] = state[0] - 1
+                if state[0] == 0:
+                    if callback is None:
+                        cv.notify()
+                    else:
+                        callback(None, buf)
 
         for idx in xrange(idxl, idxr + 1):
 
             rngl = max(offset, idx * self.block_size)
             rngr = min(offset + length, (idx + 1) * self.block_size)
             shift = rngl % self.block_size
-            to_read = rngr - rngl
 
-            def gcb(idx, shift, to_read):
-                def cb(err, obj, data):
-                    with cv:
-                        if state[1] is not None:
-                            return False
-                        if err:
-                            state[1] = err
-                            if callback:
-                                callback(err, None)
-                            else:
-                                cv.notify()
-                            return False
-                        if to_read == self.block_size:
-                            data_list[idx - idxl] = data
-                        else:
-                            with self.cache_lock:
-                                self.cache.seek(self.calc_offset(obj) + shift, os.SEEK_SET)
-                                data_list[idx - idxl] = self.cache.read(to_read)
-                        state[0] = state[0] - 1
-                        if state[0] == 0:
-                            if callback is None:
-                                cv.notify()
-                            else:
-                                callback(None, ''.join(data_list))
+            if self.read_around(idx, rngr - rngl, length):
+                def gbcb(rngl, rngr):
+                    def cb(err, data):
+                        if not err:
+                            out[rngl-offset:rngr-offset] = data
+                        finish(err)
+                    return cb
+                if trace is not None:
+                    trace.mark('bypass', idx)
+                self.gbd.read_range(idx, shift, rngr - rngl, gbcb(rngl, rngr), trace=trace)
+                continue
+
+            def gcb(rngl, rngr, shift):
+                def cb(err, obj):
+                    if not err:
+                        pos = self.calc_offset(obj) + shift
+                        out[rngl-offset:rngr-offset] = self.view[pos:pos + rngr - rngl]
+                    finish(err)
                     return False
                 return cb
-            self.pull(idx, read_data=(to_read == self.block_size), callback=gcb(idx, shift, to_read))
+            self.pull(idx, need=self.sector_mask(shift, rngr - rngl), callback=gcb(rngl, rngr, shift), trace=trace)
+
+        # A scan is read once, don't bring in what follows it either
+        if self.readahead and not (self.bypass and length >= self.BYPASS_SCAN):
+            for ridx in self.readahead.access(idxl, idxr, lambda x: x in self.map, len(self.clean_que)):
+                if ridx not in self.map:
+                    self.pull(ridx, pri=DeadlineQueue.PRI_LOW)
 
         if callback is None:
             cv.acquire()
-            while state[0] != 0:
+            while state[0] != 0 and state[1] is None:
                 cv.wait()
             cv.release()
             if state[1]:
                 raise state[1]
             else:
-                assert all(x is not None for x in data_list)
-                return ''.join(data_list)
+                return buf
 
-    def write(self, offset, data, callback=None):
+    def write(self, offset, data, callback=None, fua=False, trace=None):
 
         assert 0 <= offset < offset + len(data) <= self.total_size
 
@@ -150,16 +309,18 @@ class CachedGBD:
 
         lock = Lock()
         state = [idxr + 1 - idxl, None]
+        view = memoryview(data)
+        objs = []
 
         for idx in xrange(idxl, idxr + 1):
 
             rngl = max(offset, idx * self.block_size)
             rngr = min(offset + len(data), (idx + 1) * self.block_size)
-            ndata = data[rngl-offset:rngr-offset]
+            ndata = view[rngl-offset:rngr-offset]
             shift = rngl % self.block_size
 
             def gcb(shift, ndata):
-                def cb(err, obj, _):
+                def cb(err, obj):
                     with lock:
                         if state[1] is not None:
                             return False
@@ -168,151 +329,498 @@ class CachedGBD:
                             if callback:
                                 callback(err)
                             return False
-                        with self.cache_lock:
-                            self.cache.seek(self.calc_offset(obj) + shift, os.SEEK_SET)
-                            self.cache.write(ndata)
+                        # Before the write is acked, so a flush after it waits
+                        # for it, and before the data lands, so the journal
+                        # never has a changed entry as clean
+                        self.touch(obj)
+                        self.write_cache(obj, shift, ndata)
+                        covered = self.sector_mask(shift, len(ndata), covered=True)
+                        if covered & ~self.valid[obj]:
+                            self.valid[obj] |= covered
+                            self.log(Journal.OP_VALID, obj, self.valid[obj])
+                        objs.append(obj)
                         state[0] = state[0] - 1
-                        if state[0] == 0 and callback:
+                        if state[0] == 0 and fua:
+                            self.flush(callback or (lambda err: None), objs)
+                        elif state[0] == 0 and callback:
                             callback(None)
                     return True
                 return cb
-            cb = gcb(shift, ndata)
+            # Only sectors we partially overwrite have to be fetched first
+            need = self.sector_mask(shift, len(ndata)) & ~self.sector_mask(shift, len(ndata), covered=True)
+            self.pull(idx, need=need, callback=gcb(shift, ndata), trace=trace)
 
-            if len(ndata) == self.block_size:
-                obj = self.pull(idx, pull_data=False, callback=cb)
+    def trim(self, offset, length, callback=None, fua=False, trace=None):
+
+        assert 0 <= offset < offset + length <= self.total_size
+
+        idxl = offset // self.block_size
+        idxr = (offset + length - 1) // self.block_size
+
+        lock = Lock()
+        state = [idxr + 1 - idxl, None]
+
+        def done(err):
+            with lock:
+                if state[1] is not None:
+                    return
+                if err:
+                    state[1] = err
+                    if callback:
+                        callback(err)
+                    return
+                state[0] = state[0] - 1
+                if state[0] == 0 and callback:
+                    callback(None)
+
+        for idx in xrange(idxl, idxr + 1):
+
+            rngl = max(offset, idx * self.block_size)
+            rngr = min(offset + length, (idx + 1) * self.block_size)
+
+            if rngr - rngl == self.block_size:
+                self.pull(idx, need=0, discard=True, callback=lambda err, obj: done(err), trace=trace)
             else:
-                obj = self.pull(idx, callback=cb)
+                self.write(rngl, "\0" * (rngr - rngl), callback=done, fua=fua)
 
     def save_map(self):
+        logger.info("Saving map...")
+        self.checkpoint()
+        with self.journal.lock:
+            self.view = None
+        self.journal.close()
+        self.cache.close()
+        self.cache_file.close()
+
+    def checkpoint(self):
+
+        # Blocks first, then the map pointing at them, then the journal is
+        # started over with what the map can't hold. Flushing the blocks
+        # outside the lock only matters if the machine itself goes down.
+        if self.view is None:
+            return
+        self.cache.flush()
 
-        def pack(ull):
-            return ''.join(chr((ull >> i) % 256) for i in xrange(56, -1, -8))
+        with self.journal.lock:
 
-        logger.info("Saving map...")
-        with self.cache_lock:
-            self.cache.seek(0, 0)
-            self.cache.write(self.uuid)
-            self.cache.write(''.join(pack(ent) for ent in self.rmap))
-            self.cache.close()
+            if self.view is None:
+                return
+
+            rmap = list(self.rmap)
+            valid = list(self.valid)
+            dirties = set(self.unflushed)
+
+            self.cache[:len(self.uuid)] = self.uuid
+            struct.pack_into("!%dQ" % self.entry_count, self.cache, len(self.uuid),
+                    *[idx if idx == self.EMPTY or ent not in dirties else idx | self.DIRTY for ent, idx in enumerate(rmap)])
+            self.cache.flush()
+            self.journal.reset((Journal.OP_VALID, ent, idx, mask)
+                    for ent, (idx, mask) in enumerate(itertools.izip(rmap, valid))
+                    if idx != self.EMPTY and mask != self.full_mask)
+
+    def flush(self, callback=None, objs=None):
+
+        if callback is None:
+            done = Event()
+            self.flush(lambda err: done.set(), objs)
+            done.wait()
+            return
+
+        with self.cv:
+            if objs is None:
+                pending = set(self.unflushed)
+            else:
+                pending = set(obj for obj in objs if obj in self.unflushed)
+            if pending:
+                self.flushes.append((pending, callback))
+                self.urgent.update(pending)
+                self.flush_seq += 1
+                self.cv.notify_all()
+
+        if not pending:
+            callback(self.commit_index())
+            return
+
+        # Whatever is waiting in the dirty queue goes out first
+        for obj in list(pending):
+            idx = self.rmap[obj]
+            with self.stripe(idx):
+                if self.dirty_que.pop(obj) is not None:
+                    self.dirty_que.unget(obj)
 
     def sync(self):
         logger.info("Flushing all request to gbd...")
-        while True:
-            with self.dque_lock:
-                if self.dirty_que.empty() and self.pull_que.empty() and len(self.pull_delay_que) == 0:
-                    break
-            time.sleep(1)
+        with self.cv:
+            while self.inflight > 0:
+                self.cv.wait()
+        self.flush()
         self.gbd.sync()
 
     def end(self, force=False):
         if not force:
             self.sync()
-        self.gbd.end(True)
+        self.stop()
+        self.gbd.end(force)
         self.save_map()
+        for metric, labels, _ in self.tracked:
+            metric.remove(device=self.name, **labels)
         logger.info("End CachedGBD")
 
     ## helper
 
+    def stop(self):
+        # Nothing reaches the gbd's workers once these are gone
+        self.running = False
+        self.dirty_que.close()
+        for pull_daemon in self.pull_daemons:
+            self.pull_que.put(None, DeadlineQueue.PRI_BACKGROUND)
+        self.cp_event.set()
+        for daemon in [self.wb_daemon, self.cp_daemon] + self.pull_daemons:
+            daemon.join()
+
     def calc_entry_count(self):
-        self.cache.seek(0, os.SEEK_END)
-        entry_count = (self.cache.tell() - len(self.uuid)) // (self.block_size + 8)
+        entry_count = (len(self.cache) - len(self.uuid)) // (self.block_size + 8)
         assert entry_count > 0
         return entry_count
 
     def calc_offset(self, idx):
         return len(self.uuid) + 8 * self.entry_count + idx * self.block_size
 
-    def pull(self, idx, pull_data=True, read_data=False, callback=None):
+    # Only call these while holding the entry (popped from clean_que and
+    # dirty_que); different entries never overlap so no lock is needed.
+
+    def read_cache(self, obj, shift=0, length=None):
+        offset = self.calc_offset(obj) + shift
+        return self.cache[offset:offset + (self.block_size - shift if length is None else length)]
+
+    def write_cache(self, obj, shift, data):
+        offset = self.calc_offset(obj) + shift
+        self.view[offset:offset + len(data)] = data
+
+    def sector_mask(self, shift, length, covered=False):
+        if covered:
+            l = -(-shift // self.sector_size)
+            r = (shift + length) // self.sector_size
+        else:
+            l = shift // self.sector_size
+            r = -(-(shift + length) // self.sector_size)
+        return ((1 << r) - (1 << l)) if r > l else 0
+
+    def stripe(self, idx):
+        return self.locks[idx % self.STRIPES]
+
+    def read_around(self, idx, wanted, length):
+
+        # A cold block is read straight from the store, only the part
+        # wanted, the first time a small read or a scan asks for it. If
+        # it is read again while we remember it, it goes into the cache.
+        if not self.bypass:
+            return False
+        if wanted > self.block_size * self.BYPASS_SHARE and length < self.BYPASS_SCAN:
+            return False
+        with self.stripe(idx):
+            if idx in self.map or idx in self.busy or idx in self.queued:
+                return False
+        with self.bypass_lock:
+            if idx in self.bypass_seen:
+                del self.bypass_seen[idx]
+                return False
+            self.bypass_seen[idx] = None
+            while len(self.bypass_seen) > self.entry_count:
+                self.bypass_seen.popitem(last=False)
+            self.bypassed += 1
+            self.misses += 1
+        return True
+
+    def pull(self, idx, need=None, callback=None, discard=False, pri=DeadlineQueue.PRI_NORMAL, trace=None):
         assert 0 <= idx < self.block_count
-        assert pull_data or not read_data
-        self.pull_que.put((idx, pull_data, read_data, callback))
+        if need is None:
+            need = self.full_mask
+        assert not (discard and need)
+        with self.cv:
+            self.inflight += 1
+        if trace is not None:
+            trace.mark('pull_que', idx)
+        self.queue((idx, need, discard, callback, pri, trace), pri)
+
+    def queue(self, pack, pri):
+        idx = pack[0]
+        with self.stripe(idx):
+            self.queued[idx] = self.queued.get(idx, 0) + 1
+        self.pull_que.put(pack, pri)
+
+    def touch(self, obj):
+        self.last_modify[obj] = time.time()
+        with self.cv:
+            first = obj not in self.unflushed
+            if first:
+                self.unflushed.add(obj)
+        if first:
+            self.log(Journal.OP_DIRTY, obj)
+
+    def log(self, op, obj, mask=0):
+        if self.journal.append(op, obj, self.rmap[obj], mask) >= self.JOURNAL_LIMIT:
+            self.cp_event.set()
+
+    def flushed(self, obj):
+
+        done = []
+        with self.cv:
+            was_dirty = obj in self.unflushed
+            self.unflushed.discard(obj)
+            self.urgent.discard(obj)
+            flushes = []
+            for pending, callback in self.flushes:
+                pending.discard(obj)
+                if pending:
+                    flushes.append((pending, callback))
+                else:
+                    done.append(callback)
+            self.flushes = flushes
+
+        if was_dirty:
+            self.log(Journal.OP_CLEAN, obj)
+        err = self.commit_index() if done else None
+        for callback in done:
+            callback(err)
+
+    def commit_index(self):
+        try:
+            self.gbd.commit_index()
+        except Exception as e:
+            logger.error("Can't save index: {0}".format(repr(e)))
+            return e
+        return None
 
     ## daemon
 
-    def check_delay_pull(self, idx):
-        with self.dque_lock:
-            if idx in self.pull_delay_que:
-                pack = self.pull_delay_que[idx].get()
-                logging.debug("Put pack {0}".format(pack))
-                self.pull_que.put(pack, TimedPriorityQueue.PRI_HIGH)
-                if self.pull_delay_que[idx].empty():
-                    del self.pull_delay_que[idx]
-
     def do_pull(self):
+        while True:
+            pack = self.pull_que.get()
+            if pack is None:
+                return
+            try:
+                self.dispatch(pack)
+            except Exception as e:
+                logger.error("Pull failed: {0}".format(repr(e)))
+
+    def dispatch(self, pack):
+
+        idx, need, discard, callback, pri, trace = pack
+        if trace is not None:
+            trace.mark('dispatch', idx)
+
+        with self.stripe(idx):
+            self.queued[idx] -= 1
+            if self.queued[idx] == 0:
+                del self.queued[idx]
+            if idx in self.busy:
+                logger.debug("Join {0}".format(pack))
+                if trace is not None:
+                    trace.mark('busy', idx)
+                self.busy[idx].append(pack)
+                return
+            if idx in self.map:
+                obj = self.map[idx]
+                cobj = self.clean_que.pop(obj)
+                dobj = self.dirty_que.pop(obj)
+                assert cobj is None or dobj is None
+                if cobj is None and dobj is None:
+                    # Held by writeback or being evicted, whoever holds it
+                    # takes care of us when letting it go.
+                    logger.debug("Delay {0}".format(pack))
+                    if trace is not None:
+                        trace.mark('busy', idx)
+                    self.busy[idx] = [pack]
+                    return
+                self.hits += 1
+            else:
+                obj = None
+                if not discard:
+                    self.misses += 1
+            self.busy[idx] = []
+
+        if obj is not None:
+            if discard:
+                self.discard(idx, obj, dobj is not None, callback, trace)
+            else:
+                self.run(idx, obj, dobj is not None, [pack])
+            return
 
+        if discard:
+            # Nothing cached to drop, no entry is worth evicting for it
+            self.discard(idx, None, False, callback, trace)
+            return
+
+        obj = self.clean_que.get(idx)
+        self.evict(obj)
+        with self.stripe(idx):
+            self.rmap[obj] = idx
+            self.map[idx] = obj
+            self.digest[obj] = self.gbd.digest(idx)
+            self.valid[obj] = 0
+        # Before anything of idx is written into the entry
+        self.log(Journal.OP_MAP, obj)
+
+        if need:
+            logger.debug("Pull {0} => {1}".format(idx, obj))
+            self.gbd.read_block(idx, self.gen_pull_cb(idx, obj, pack), pri, trace)
+        else:
+            self.run(idx, obj, False, [pack])
+
+    def gen_pull_cb(self, idx, obj, pack):
+        def cb(err, data):
+            if err:
+                logger.error("Pull {0} => {1}: Fail".format(idx, obj))
+                with self.stripe(idx):
+                    del self.map[idx]
+                    self.rmap[obj] = self.EMPTY
+                    self.digest[obj] = None
+                    packs = [pack] + self.busy.pop(idx)
+                self.log(Journal.OP_UNMAP, obj)
+                self.clean_que.unget(obj)
+                for _, _, _, callback, _, _ in packs:
+                    self.call(callback, err, None)
+            else:
+                self.digest[obj] = self.gbd.digest(idx)
+                logger.debug("Pull {0} => {1}: Check = {2}".format(idx, obj, self.digest[obj]))
+                self.merge(obj, data)
+                self.run(idx, obj, False, [pack])
+                logger.debug("Pull {0} => {1}: End".format(idx, obj))
+        return cb
+
+    def evict(self, obj):
+        old = self.rmap[obj]
+        if old == self.EMPTY:
+            return
+        with self.stripe(old):
+            del self.map[old]
+            self.rmap[obj] = self.EMPTY
+            self.evictions += 1
+            packs = self.busy.pop(old, [])
+        for pack in packs:
+            self.queue(pack, DeadlineQueue.PRI_HIGH)
+
+    def run(self, idx, obj, dirty, packs, front=False):
+
+        # Serve requests on an entry we hold, then let it go. Everything that
+        # queued up on idx meanwhile is served in the same pass.
+        # Readahead brings no callback and doesn't count as a use.
+        served = False
         while True:
+            for i, pack in enumerate(packs):
+                _, need, discard, callback, pri, trace = pack
+                served = served or callback is not None
+                if discard:
+                    with self.stripe(idx):
+                        self.busy[idx][:0] = packs[i+1:]
+                    self.discard(idx, obj, dirty, callback, trace)
+                    return
+                if need & ~self.valid[obj]:
+                    self.fill(idx, obj, pri, self.gen_resume_cb(idx, obj, dirty, packs[i:], front), trace)
+                    return
+                if trace is not None:
+                    trace.mark('serve', idx)
+                if self.call(callback, None, obj):
+                    dirty = True
+            with self.stripe(idx):
+                packs = self.busy.get(idx)
+                if not packs:
+                    self.busy.pop(idx, None)
+                    if dirty and (front or obj in self.urgent):
+                        self.dirty_que.unget(obj)
+                    elif dirty:
+                        self.dirty_que.put(obj)
+                    else:
+                        self.clean_que.put(obj, idx, served)
+                    return
+                self.busy[idx] = []
+
+    def gen_resume_cb(self, idx, obj, dirty, packs, front):
+        def cb(err):
+            if err:
+                self.call(packs[0][3], err, None)
+                self.run(idx, obj, dirty, packs[1:], front)
+            else:
+                self.run(idx, obj, dirty, packs, front)
+        return cb
 
-            pack = self.pull_que.get()
+    def fill(self, idx, obj, pri, callback, trace=None):
 
-            data = None
-            modify = False
-            idx, pull_data, read_data, callback = pack
-
-            with self.map_lock:
-                if idx in self.map:
-                    new_block = False
-                    obj = self.map[idx]
-                    with self.dque_lock:
-                        cobj = self.clean_que.pop(obj)
-                        dobj = self.dirty_que.pop(obj)
-                        assert cobj is None or dobj is None
-                        if cobj is None and dobj is None:
-                            logging.debug("Delay {0}".format(pack))
-                            if idx not in self.pull_delay_que:
-                                self.pull_delay_que[idx] = Queue()
-                            self.pull_delay_que[idx].put(pack)
-                            continue
-                else:
-                    new_block = True
-                    obj = self.clean_que.get()
-                    if self.rmap[obj] != self.EMPTY:
-                        del self.map[self.rmap[obj]]
-                    self.rmap[obj] = idx
-                    self.map[idx] = obj
-
-            if not new_block:
-                if read_data:
-                    with self.cache_lock:
-                        self.cache.seek(self.calc_offset(obj), os.SEEK_SET)
-                        data = self.cache.read(self.block_size)
+        logger.debug("Fill {0} => {1}".format(idx, obj))
 
+        def cb(err, data):
+            if err:
+                logger.error("Fill {0} => {1}: Fail".format(idx, obj))
             else:
-                logger.debug("Pull {0} => {1}".format(idx, obj))
-                if pull_data or read_data:
-                    def gcb(idx, obj, callback):
-                        def cb(err, data):
-                            if err:
-                                logger.error("Pull {0} => {1}: Fail".format(idx, obj))
-                                raise NotImplementedError("Need to propagate pull error")
-                            else:
-                                logger.debug("Pull {0} => {1}: Check = {2}".format(idx, obj, hashlib.sha1(data).hexdigest()))
-                                with self.cache_lock:
-                                    self.cache.seek(self.calc_offset(obj), os.SEEK_SET)
-                                    self.cache.write(data)
-                                if callback and callback(None, obj, data):
-                                    self.last_modify[obj] = time.time()
-                                    self.dirty_que.put(obj)
-                                else:
-                                    self.clean_que.put(obj)
-                                self.check_delay_pull(idx)
-                                logger.debug("Pull {0} => {1}: End".format(idx, obj))
-                        return cb
-                    self.gbd.read_block(idx, gcb(idx, obj, callback))
-                    continue
-                else:
-                    modify = True
+                self.digest[obj] = self.gbd.digest(idx)
+                self.merge(obj, data)
+            callback(err)
 
-            assert data is None or len(data) == self.block_size
+        self.gbd.read_block(idx, cb, pri, trace)
 
-            if callback and callback(None, obj, data):
-                modify = True
-            if dobj is not None or modify:
-                if modify:
-                    self.last_modify[obj] = time.time()
-                self.dirty_que.put(obj)
+    def merge(self, obj, data):
+        missing = self.full_mask & ~self.valid[obj]
+        if missing == self.full_mask:
+            self.write_cache(obj, 0, data)
+        else:
+            # Runs of 1s, lowest sector first
+            view = memoryview(data)
+            for run in re.finditer('1+', bin(missing)[:1:-1]):
+                l, r = run.start() * self.sector_size, run.end() * self.sector_size
+                self.write_cache(obj, l, view[l:r])
+        self.valid[obj] = self.full_mask
+        self.log(Journal.OP_VALID, obj, self.full_mask)
+
+    def call(self, callback, err, obj):
+        # Every request pulled ends up here exactly once
+        try:
+            return callback and callback(err, obj)
+        except Exception as e:
+            logger.error("Callback failed: {0}".format(repr(e)))
+        finally:
+            with self.cv:
+                self.inflight -= 1
+                if self.inflight == 0:
+                    self.cv.notify_all()
+
+    def discard(self, idx, obj, dirty, callback, trace=None):
+
+        logger.debug("Discard {0} => {1}".format(idx, obj))
+
+        # obj is None when idx isn't cached
+        def cb(err, _):
+            if err:
+                logger.error("Discard {0} => {1}: Fail".format(idx, obj))
+                self.call(callback, err, obj)
+                if obj is not None:
+                    self.run(idx, obj, dirty, [])
+                    return
             else:
-                self.clean_que.put(obj)
-            self.check_delay_pull(idx)
+                if obj is not None:
+                    with self.stripe(idx):
+                        del self.map[idx]
+                        self.rmap[obj] = self.EMPTY
+                        self.digest[obj] = None
+                        self.valid[obj] = 0
+                    self.log(Journal.OP_UNMAP, obj)
+                    self.flushed(obj)
+                    self.clean_que.unget(obj)
+                self.call(callback, None, obj)
+            with self.stripe(idx):
+                packs = self.busy.pop(idx)
+            for pack in packs:
+                self.queue(pack, DeadlineQueue.PRI_HIGH)
+
+        self.gbd.trim_block(idx, cb, trace=trace)
+
+    def do_checkpoint(self):
+        while True:
+            self.cp_event.wait()
+            self.cp_event.clear()
+            if not self.running:
+                return
+            self.checkpoint()
 
     def do_writeback(self):
 
@@ -322,38 +830,69 @@ class CachedGBD:
 
             self.wb_sem.acquire()
             ent = self.dirty_que.get()
+            if ent is None:
+                return
+
+            # The entry is ours until it is let go through run()
+            idx = self.rmap[ent]
+
+            # Entries a flush waits for go out right away
+            pri = DeadlineQueue.PRI_NORMAL if ent in self.urgent else DeadlineQueue.PRI_BACKGROUND
 
             to_sleep = self.last_modify[ent] + delay - time.time()
-            if to_sleep > 0:
+            if to_sleep > 0 and pri == DeadlineQueue.PRI_BACKGROUND:
+                seq = self.flush_seq
                 self.wb_sem.release()
                 logging.debug("Sleep wb {0}".format(to_sleep))
-                self.dirty_que.unget(ent)
-                time.sleep(to_sleep)
+                self.run(idx, ent, True, [], front=True)
+                with self.cv:
+                    if self.flush_seq == seq:
+                        self.cv.wait(to_sleep)
                 continue
 
-            with self.map_lock:
-                idx = self.rmap[ent]
-                assert self.map[idx] == ent
-
             logger.debug("Collected {0}".format(ent))
-            with self.cache_lock:
-                self.cache.seek(self.calc_offset(ent), os.SEEK_SET)
-                data = self.cache.read(self.block_size)
-
-            logger.debug("Push {0} <= {1}: Check = {2}".format(idx, ent, hashlib.sha1(data).hexdigest()))
+            if self.valid[ent] == self.full_mask:
+                self.push(idx, ent, pri)
+                continue
 
+            # The sectors we never had must be fetched before the block can go out
             def gcb(idx, ent):
-                def cb(err, _):
+                def cb(err):
                     if err:
-                        logger.warning("Push {0} <= {1}: Fail".format(idx, ent))
-                        self.dirty_que.put(ent)
+                        self.run(idx, ent, True, [])
+                        self.wb_sem.release()
                     else:
-                        logger.debug("Push {0} <= {1}: Success".format(idx, ent))
-                        self.clean_que.put(ent)
-                    self.check_delay_pull(idx)
-                    self.wb_sem.release()
+                        self.push(idx, ent, pri)
                 return cb
-            self.gbd.write_block(idx, data, gcb(idx, ent), TimedPriorityQueue.PRI_LOW)
+            self.fill(idx, ent, pri, gcb(idx, ent))
+
+    def push(self, idx, ent, pri):
+
+        data = self.read_cache(ent)
+
+        digest = hashlib.sha1(data).hexdigest()
+        if self.digest[ent] is None:
+            self.digest[ent] = self.gbd.digest(idx)
+        if digest == self.digest[ent]:
+            logger.debug("Push {0} <= {1}: Unchanged".format(idx, ent))
+            self.flushed(ent)
+            self.run(idx, ent, False, [])
+            self.wb_sem.release()
+            return
+
+        logger.debug("Push {0} <= {1}: Check = {2}".format(idx, ent, digest))
+
+        def cb(err, _):
+            if err:
+                logger.warning("Push {0} <= {1}: Fail".format(idx, ent))
+            else:
+                logger.debug("Push {0} <= {1}: Success".format(idx, ent))
+                self.digest[ent] = digest
+                self.pushed += 1
+                self.flushed(ent)
+            self.run(idx, ent, err is not None, [])
+            self.wb_sem.release()
+        self.gbd.write_block(idx, data, cb, pri)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,100 @@
+#!/usr/bin/python2
+
+import bz2
+import zlib
+import struct
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+class Codec:
+
+    MAGIC = 'GBDZ'
+    HEADER = struct.Struct("!4sB")
+
+    CODEC_RAW = 0
+    CODEC_ZLIB = 1
+    CODEC_BZ2 = 2
+    CODEC_LZMA = 3
+
+    NAMES = {
+        'none': CODEC_RAW,
+        'zlib': CODEC_ZLIB,
+        'bz2': CODEC_BZ2,
+        'lzma': CODEC_LZMA,
+    }
+
+    # Probe this many bytes with a cheap zlib pass before compressing the
+    # whole block, and store the block raw if the probe doesn't shrink enough.
+    PROBE_SIZE = 4096
+    PROBE_RATIO = 0.9
+
+    def __init__(self, block_size, name='none', level=None):
+
+        if name not in self.NAMES:
+            raise ValueError("Unknown compression `{0}'".format(name))
+        if name == 'lzma' and lzma is None:
+            raise RuntimeError("lzma compression needs the lzma module (backports.lzma on python2)")
+
+        self.block_size = block_size
+        self.name = name
+        self.codec = self.NAMES[name]
+        self.level = level
+
+    ## interface
+
+    def encode(self, data):
+
+        if self.codec == self.CODEC_RAW or self.incompressible(data):
+            return data
+
+        payload = self.compress(self.codec, data)
+        if self.HEADER.size + len(payload) >= self.block_size:
+            return data
+        return self.HEADER.pack(self.MAGIC, self.codec) + payload
+
+    def seekable(self):
+        # Every block is stored as is, so part of one can be fetched alone
+        return self.codec == self.CODEC_RAW
+
+    def decode(self, data):
+
+        # Raw blocks are always exactly block_size, encoded ones are shorter
+        if len(data) == self.block_size:
+            return data
+
+        magic, codec = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise AssertionError("Bad block header")
+        return self.decompress(codec, data[self.HEADER.size:])
+
+    ## helper
+
+    def incompressible(self, data):
+        probe = data[:self.PROBE_SIZE]
+        return len(zlib.compress(probe, 1)) > len(probe) * self.PROBE_RATIO
+
+    def compress(self, codec, data):
+        if codec == self.CODEC_ZLIB:
+            return zlib.compress(data, 6 if self.level is None else self.level)
+        elif codec == self.CODEC_BZ2:
+            return bz2.compress(data, 9 if self.level is None else self.level)
+        elif codec == self.CODEC_LZMA:
+            return lzma.compress(data, preset=self.level)
+        raise ValueError("Unknown codec {0}".format(codec))
+
+    def decompress(self, codec, data):
+        if codec == self.CODEC_ZLIB:
+            return zlib.decompress(data)
+        elif codec == self.CODEC_BZ2:
+            return bz2.decompress(data)
+        elif codec == self.CODEC_LZMA:
+            if lzma is None:
+                raise RuntimeError("Block is lzma compressed but lzma is not available")
+            return lzma.decompress(data)
+        raise ValueError("Unknown codec {0}".format(codec))
@@ -15,4 +15,42 @@ Config = {
 
     'gbd_data_folder': 'W-GBD_DATA',
 
+    # Used when a new export is created: none, zlib, bz2 or lzma
+    'default_compression': 'none',
+    'default_compression_level': None,
+
+    # Used when a new export is created: block (one file per block), cas
+    # (content addressed, identical blocks are stored once) or log (blocks
+    # written together are packed into segments of segment_size bytes)
+    'default_layout': 'block',
+    'segment_size': 8 << 20,
+
+    # Block requests per second to start with, the workers adjust it to
+    # what the store takes (0: no limit until the store pushes back)
+    'backend_rate': 0,
+
+    # Empty block files kept ready for first writes, created in batches
+    # in the background (0: create each one as it is written)
+    'spare_blocks': 100,
+
+    # Cache replacement policy: lru, 2q or arc (2q and arc keep the hot
+    # blocks through large scans)
+    'cache_policy': 'lru',
+
+    # Read small parts of cold blocks and large scans straight from the
+    # store, without taking a cache entry, until they are read again
+    'cache_bypass': True,
+
+    # Serve metrics in the prometheus text format over http, on host:port
+    # or on a unix socket path (None: off)
+    'metrics_address': None,
+
+    # Write a sample of the requests, with the time spent in every stage,
+    # to trace_path in the chrome trace event format (None: off)
+    'trace_path': None,
+    'trace_rate': 0.01,
+
+    # Save every nbd request to record_path, bench.py -r replays it
+    'record_path': None,
+
 }
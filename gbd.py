@@ -4,35 +4,65 @@ import json
 import hashlib
 import logging
 import time
-import random
 
 from threading import Thread, Lock, Semaphore
 from config import Config, Metadata
-from util import TimedPriorityQueue
-from auth import AuthManager
-from apiclient import errors as apierrors
-from apiclient.discovery import build as build_service
-from apiclient.http import MediaInMemoryUpload
+from util import DeadlineQueue
+from codec import Codec
+from index import Index
+from layout import BlockLayout, ContentLayout, SegmentLayout
+from backend import RateLimitError, DriveBackend, LocalBackend
+from metrics import REGISTRY
+from tracing import TracedBackend
+from throttle import Throttle
 
 logger = logging.getLogger('gbd')
 
+class Range:
+
+    # Queued in place of a write's data to read part of a block
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
 class GBDWorker(Thread):
 
-    def __init__(self, gbd, drive):
+    MAX_TRIES = 5
+
+    def __init__(self, gbd, backend, number=0):
         Thread.__init__(self)
         self.gbd = gbd
-        self.drive = drive
+        self.backend = backend
+        self.number = number
 
     def run(self):
         while True:
-            idx, data, cb = self.gbd.que.get()
+            item = self.gbd.que.get()
+            if item is None:
+                self.gbd.que.task_done()
+                return
+            idx, data, cb, trace = item
             err, ret = None, None
+            op = 'read' if data is None else 'trim' if data is GBD.TRIM else 'range' if isinstance(data, Range) else 'write'
+            start = time.time()
+            backend = self.backend
+            if trace is not None:
+                # Finding the block under gbd.lock, until the store is called
+                trace.mark('layout', idx)
+                backend = TracedBackend(backend, trace, idx)
             try:
-                ret = self.do_request(idx, data)
+                ret = self.do_request(backend, idx, data, trace)
             except Exception as e:
                 err = e
                 logger.error("I/O failed: {0}".format(e))
             finally:
+                self.gbd.requests.inc(device=self.gbd.name, worker=self.number, op=op, result='error' if err else 'ok')
+                self.gbd.latency.observe(time.time() - start, device=self.gbd.name, op=op)
+                if op in ('write', 'trim'):
+                    self.gbd.changed = True
+                if trace is not None:
+                    trace.mark('callback', idx)
                 try:
                     if cb:
                         cb(err, ret)
@@ -41,131 +71,134 @@ class GBDWorker(Thread):
                 finally:
                     self.gbd.que.task_done()
 
-    def do_request(self, idx, data):
-        for rnd in xrange(5):
+    def do_request(self, backend, idx, data, trace=None):
+        if self.gbd.layout.OWN_THROTTLE and data is not None and not isinstance(data, Range):
+            return self.trim_block(backend, idx) if data is GBD.TRIM else self.write_block(backend, idx, data)
+        # Every attempt goes through the throttle shared by all workers,
+        # which also does the backing off
+        for rnd in xrange(self.MAX_TRIES):
+            if not self.gbd.throttle.acquire(retry=rnd > 0):
+                raise RateLimitError('retryBudgetExhausted')
+            throttled = False
             try:
                 if data is None:
-                    return self.read_block(idx)
+                    return self.read_block(backend, idx)
+                elif data is GBD.TRIM:
+                    return self.trim_block(backend, idx)
+                elif isinstance(data, Range):
+                    return self.read_range(backend, idx, data.offset, data.length)
                 else:
-                    return self.write_block(idx, data)
-            except apierrors.HttpError as e:
-                if e.resp.status == 403:
-                    reason = json.loads(e.content)['error']['errors'][0]['reason']
-                    if reason in ['rateLimitExceeded', 'userRateLimitExceeded']:
-                        logger.warning("Random backoff ({0})".format(reason))
-                        time.sleep((2 ** rnd) + random.randint(0, 999) / 1000)
-                        continue
-                raise
-
-    def read_block(self, idx):
-        blkid = self.gbd.block_id(idx)
-        if blkid is None:
-            return "\0" * self.gbd.block_size
-        else:
-            results = self.drive.files().get_media(fileId=blkid).execute()
-            assert len(results) == self.gbd.block_size
-            return results
+                    return self.write_block(backend, idx, data)
+            except RateLimitError as e:
+                throttled = True
+                self.gbd.backoffs.inc(device=self.gbd.name, worker=self.number)
+                if rnd + 1 == self.MAX_TRIES:
+                    raise
+                logger.warning("Backoff ({0})".format(e.reason))
+                if trace is not None:
+                    trace.mark('backoff', idx)
+            finally:
+                self.gbd.throttle.release(throttled)
 
-    def write_block(self, idx, data):
+    def read_block(self, backend, idx):
+        return self.gbd.layout.read(backend, idx)
+
+    def read_range(self, backend, idx, offset, length):
+        return self.gbd.layout.read_range(backend, idx, offset, length)
+
+    def write_block(self, backend, idx, data):
         assert len(data) == self.gbd.block_size
-        blkid = self.gbd.block_id(idx)
-        if blkid is None:
-            return self.gbd.new_block(idx, data)
-        else:
-            media_body = MediaInMemoryUpload(data, mimetype=self.gbd.BLOCK_MIMETYPE, resumable=False)
-            return self.drive.files().update(fileId=blkid, media_body=media_body).execute()
+        if data == self.gbd.zero_block:
+            return self.trim_block(backend, idx)
+        return self.gbd.layout.write(backend, idx, data)
+
+    def trim_block(self, backend, idx):
+        return self.gbd.layout.trim(backend, idx)
 
 class GBD:
 
-    FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
-    BLOCK_MIMETYPE = 'application/octet-stream'
+    TRIM = object()
+    # Marks the index as saved by a clean shutdown
+    CLEAN = 'clean'
+    # What changed since the index was saved, see commit_index()
+    DELTA = 'index_delta'
+    MAX_DELTAS = 256
+
+    BACKENDS = {
+        'drive': DriveBackend,
+        'local': LocalBackend,
+    }
+
+    LAYOUTS = {
+        'block': BlockLayout,
+        'cas': ContentLayout,
+        'log': SegmentLayout,
+    }
 
     def __init__(self, **config):
 
         self.config = Config.copy()
         self.config.update(config)
 
-        self.auth_mgr = AuthManager(
-            self.config['appname'],
-            self.config['oauth_client_id'],
-            self.config['oauth_client_secret'],
-            self.config['oauth_scope'],
-            self.config['oauth_redirect_uri'])
-        self.drive = self.build_service()
+        self.name = self.config['gbd_data_folder']
+        self.requests = REGISTRY.counter('gbd_backend_requests_total', 'Block requests served by the store', ('device', 'worker', 'op', 'result'))
+        self.latency = REGISTRY.histogram('gbd_backend_request_seconds', 'Time to serve a block request, retries included', ('device', 'op'))
+        self.backoffs = REGISTRY.counter('gbd_backend_backoffs_total', 'Requests retried after hitting the rate limit', ('device', 'worker'))
+        self.depth = REGISTRY.gauge('gbd_queue_depth', 'Requests waiting in a queue', ('device', 'queue'))
+        self.throttle_limit = REGISTRY.gauge('gbd_backend_concurrency_limit', 'Block requests the throttle lets run at a time', ('device',))
+        self.throttle_rate = REGISTRY.gauge('gbd_backend_rate_limit', 'Block requests per second the throttle lets out (0: no limit yet)', ('device',))
 
-        self.data_dir = self.get_data_dir()
-        self.uuid = hashlib.sha1(self.data_dir).hexdigest()
+        self.backend = self.build_backend()
+        self.uuid = hashlib.sha1(self.backend.location).hexdigest()
         self.load_data_dir()
 
         self.block_size = self.bd_attr['block_size']
         self.block_count = self.bd_attr['block_count']
         self.total_size = self.block_size * self.block_count
-        self.mapping = [None] * self.block_count
-        self.que = TimedPriorityQueue()
+        self.zero_block = "\0" * self.block_size
+        self.zero_digest = hashlib.sha1(self.zero_block).hexdigest()
+        self.codec = Codec(self.block_size, self.bd_attr.get('compression', 'none'), self.bd_attr.get('compression_level'))
+        workers = self.config.get('workers', 8)
+        # Writeback and readahead can't take every worker from reads
+        self.que = DeadlineQueue(workers, max(1, workers // 4))
+        self.depth.track(self.que.qsize, device=self.name, queue='backend')
         self.lock = Lock()
+        self.index_lock = Lock()
+        # Set by every write and trim, cleared when the index is saved
+        self.changed = False
+        self.layout = self.LAYOUTS[self.bd_attr.get('layout', 'block')](self)
+        self.load_index()
+
+        self.throttle = Throttle(workers, self.config.get('backend_rate', 0))
+        self.throttle_limit.track(lambda: self.throttle.limit, device=self.name)
+        self.throttle_rate.track(lambda: self.throttle.rate or 0, device=self.name)
 
         self.running = True
         self.workers = []
-        for i in xrange(self.config.get('workers', 8)):
-            worker = GBDWorker(self, self.build_service())
+        for i in xrange(workers):
+            worker = GBDWorker(self, self.backend.clone(), i)
             worker.daemon = True
             worker.start()
             self.workers.append(worker)
 
     ## init
 
-    def build_service(self):
-        return build_service('drive', 'v2', http=self.auth_mgr.get_auth_http())
-
-    def get_data_dir(self):
-
-        folder = self.config['gbd_data_folder']
-        query_str = "title='{0}'".format(folder)
-
-        results = self.drive.files().list(q=query_str).execute()
-        items = filter(lambda x: not x['labels']['trashed'], results['items'])
-        if len(items) == 0:
-            if not self.config.get('create', False):
-                raise RuntimeError("Can't locate `{0}'".format(folder))
-            else:
-                return self.create_data_dir()
-        if len(items) > 1:
-            raise AssertionError("{0} results found for `{1}', don't know which to use".format(len(items), folder))
-
-        item = items[0]
-        if item['mimeType'] != self.FOLDER_MIMETYPE:
-            raise AssertionError("`{0}' is not a folder!! (mimeType={1})".format(folder, item['mimeType']))
-        if not item['editable']:
-            raise RuntimeError("folder `{0}' is readonly!".format(folder))
-
-        return item['id']
-
-    def create_data_dir(self):
-
-        folder = self.config['gbd_data_folder']
-        body = {
-            'title': folder,
-            'parents': ['root'],
-            'mimeType': self.FOLDER_MIMETYPE,
-        }
-        result = self.drive.files().insert(body=body).execute()
-
-        if not result:
-            raise RuntimeError("Can't create folder `{0}'".format(folder))
-        return result['id']
+    def build_backend(self):
+        backend = self.config.get('backend', 'drive')
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown backend `{0}'".format(backend))
+        return self.BACKENDS[backend](self.config)
 
     def load_data_dir(self):
 
-        query_str = "title='config'"
-        results = self.drive.children().list(folderId=self.data_dir, q=query_str).execute()
-        if len(results['items']) == 0:
+        results = self.backend.find('config')
+        if len(results) == 0:
             self.init_data_dir()
             return
-        if len(results['items']) > 1:
+        if len(results) > 1:
             raise AssertionError("config file should be unique")
 
-        fileId = results['items'][0]['id']
-        results = self.drive.files().get_media(fileId=fileId).execute()
+        results = self.backend.read(results[0])
         assert results
 
         self.bd_attr = json.loads(results)
@@ -195,85 +228,214 @@ class GBD:
             'version': Metadata['version'],
             'block_size': block_size,
             'block_count': used_size // block_size,
+            'compression': self.config.get('default_compression', 'none'),
+            'compression_level': self.config.get('default_compression_level'),
+            'layout': self.config.get('default_layout', 'block'),
         }
-        body = {
-            'title': 'config',
-            'description': 'config file for gbd',
-            'mimeType': 'application/json',
-            'parents': [{'id': self.data_dir}],
-        }
-        media_body = MediaInMemoryUpload(json.dumps(self.bd_attr), mimetype='application/json', resumable=False)
+        if self.bd_attr['compression'] not in Codec.NAMES:
+            raise ValueError("Unknown compression `{0}'".format(self.bd_attr['compression']))
+        if self.bd_attr['layout'] not in self.LAYOUTS:
+            raise ValueError("Unknown layout `{0}'".format(self.bd_attr['layout']))
+        self.backend.allocate('config', json.dumps(self.bd_attr), 'application/json')
+
+    def load_index(self):
+
+        self.index_id = None
+        index = None
+        # Left behind by a crash, anything written since it was saved is gone
+        self.stale_index = False
+        self.index_size = 0
+        self.deltas = []
+        self.delta_size = 0
+        self.next_delta = 0
+        # Cleared when a delta couldn't be saved, the changes it held are
+        # only in the layout then
+        self.deltas_ok = True
+
+        results = self.backend.find('index')
+        if len(results) > 1:
+            raise AssertionError("index file should be unique")
+
+        if len(results) == 1:
+            self.index_id = results[0]
+            data = self.backend.read(self.index_id)
+            self.index_size = len(data)
+            index = Index.decode(data)
+            if index['block_count'] != self.block_count:
+                raise AssertionError("Index doesn't match config")
+            if index['layout'] != self.bd_attr.get('layout', 'block'):
+                raise AssertionError("Index doesn't match layout")
+            # Left by a clean shutdown, until the next one the index may
+            # fall behind. Cheaper than saving the whole index again.
+            markers = self.backend.find(self.CLEAN)
+            for blkid in markers:
+                self.backend.delete(blkid)
+            index['clean'] = bool(markers)
+            self.stale_index = not index['clean']
+
+        if self.layout.INDEX_ONLY:
+            self.load_deltas(index)
+        self.layout.load(self.backend, index)
+        if self.index_id is None:
+            self.save_index(clean=False)
+
+    def load_deltas(self, index):
+
+        deltas = []
+        for blkid in self.backend.find(self.DELTA):
+            data = self.backend.read(blkid)
+            deltas.append((Index.decode(data), blkid, len(data)))
+        deltas.sort(key=lambda delta: delta[0]['seq'])
+
+        # Those below the index's own count are in it already
+        first = index['delta'] if index is not None else None
+        changes = []
+        for delta, blkid, size in deltas:
+            if first is None or delta['seq'] < first:
+                self.backend.delete(blkid)
+                continue
+            changes.extend(delta['changes'])
+            self.deltas.append(blkid)
+            self.delta_size += size
+            self.next_delta = delta['seq'] + 1
+        if self.deltas:
+            logger.info("Loaded {0} index deltas".format(len(self.deltas)))
+        if index is not None:
+            index['changes'] = changes
+            self.next_delta = max(self.next_delta, first)
+
+    def save_index(self, clean=True):
+
+        with self.index_lock:
+
+            self.changed = False
+            self.deltas_ok = True
+            header, tables = self.layout.dump()
+            header['block_count'] = self.block_count
+            header['layout'] = self.bd_attr.get('layout', 'block')
+            header['delta'] = self.next_delta
+            index = Index.encode(header, tables)
+
+            if self.index_id is None:
+                self.index_id = self.backend.allocate('index', index)
+            else:
+                self.backend.write(self.index_id, index)
+            self.index_size = len(index)
+
+            # The next load skips them anyway
+            deltas, self.deltas, self.delta_size = self.deltas, [], 0
+            for blkid in deltas:
+                try:
+                    self.backend.delete(blkid)
+                except Exception as e:
+                    logger.warning("Can't remove index delta {0}: {1}".format(blkid, repr(e)))
+
+            if clean:
+                self.backend.allocate(self.CLEAN, '')
 
-        self.drive.files().insert(body=body, media_body=media_body).execute()
-    
     ## function
 
-    def read_block(self, idx, cb=None, pri=TimedPriorityQueue.PRI_NORMAL):
+    def read_block(self, idx, cb=None, pri=DeadlineQueue.PRI_NORMAL, trace=None):
         assert 0 <= idx < self.block_count
         if cb:
-            self.que.put((idx, None, cb), pri)
+            if trace is not None:
+                trace.mark('backend_que', idx)
+            self.que.put((idx, None, cb, trace), pri)
         else:
             return self.sync_io(idx, None, pri)
 
-    def write_block(self, idx, data, cb=None, pri=TimedPriorityQueue.PRI_NORMAL):
+    def read_range(self, idx, offset, length, cb=None, pri=DeadlineQueue.PRI_NORMAL, trace=None):
+        # Only fetches the range when the layout can, the whole block otherwise
+        assert 0 <= idx < self.block_count
+        assert 0 <= offset < offset + length <= self.block_size
+        if cb:
+            if trace is not None:
+                trace.mark('backend_que', idx)
+            self.que.put((idx, Range(offset, length), cb, trace), pri)
+        else:
+            return self.sync_io(idx, Range(offset, length), pri)
+
+    def write_block(self, idx, data, cb=None, pri=DeadlineQueue.PRI_NORMAL, trace=None):
         assert 0 <= idx < self.block_count
         assert data and len(data) == self.block_size
         if cb:
-            self.que.put((idx, data, cb), pri)
+            if trace is not None:
+                trace.mark('backend_que', idx)
+            self.que.put((idx, data, cb, trace), pri)
         else:
             return self.sync_io(idx, data, pri)
 
+    def trim_block(self, idx, cb=None, pri=DeadlineQueue.PRI_NORMAL, trace=None):
+        assert 0 <= idx < self.block_count
+        if cb:
+            if trace is not None:
+                trace.mark('backend_que', idx)
+            self.que.put((idx, self.TRIM, cb, trace), pri)
+        else:
+            return self.sync_io(idx, self.TRIM, pri)
+
     def sync(self):
         logger.info("Syncing...")
         self.que.join()
+        try:
+            self.layout.collect(self.backend)
+        except Exception as e:
+            logger.warning("Collect failed: {0}".format(e))
+        if self.layout.INDEX_ONLY:
+            self.save_index(clean=False)
+
+    def commit_index(self):
+
+        # Where the index is all there is, what was written since it was
+        # saved isn't durable until it is saved again. The changes go up on
+        # their own, the whole index only once they add up to as much.
+        if not self.layout.INDEX_ONLY or not self.changed:
+            return
+
+        with self.index_lock:
+            if self.deltas_ok and len(self.deltas) < self.MAX_DELTAS and self.delta_size < self.index_size:
+                self.changed = False
+                header, tables = self.layout.dump_changes()
+                if not any(rows for _, rows in tables.itervalues()):
+                    return
+                header['seq'] = self.next_delta
+                delta = Index.encode(header, tables)
+                try:
+                    self.deltas.append(self.backend.allocate(self.DELTA, delta))
+                except Exception:
+                    self.deltas_ok = False
+                    self.changed = True
+                    raise
+                self.next_delta += 1
+                self.delta_size += len(delta)
+                return
+
+        self.save_index(clean=False)
 
     def end(self, force):
         if not force:
             self.sync()
+        self.stop()
+        self.layout.close()
+        logger.info("Saving block index...")
+        self.save_index(clean=not force)
+        self.depth.remove(device=self.name, queue='backend')
+        self.throttle_limit.remove(device=self.name)
+        self.throttle_rate.remove(device=self.name)
         logger.info("End GBD")
 
     ## helper
 
-    @classmethod
-    def idx_to_name(cls, idx):
-        return "gbd_b" + str(idx)
-
-    def block_id(self, idx):
-        with self.lock:
-            if idx >= self.block_count or idx < 0:
-                raise IndexError("Can't map idx {0}".format(idx))
-            if self.mapping[idx] is None:
-                query_str = "title='{0}'".format(self.idx_to_name(idx))
-                results = self.drive.children().list(folderId=self.data_dir, q=query_str).execute()
-                if len(results['items']) == 1:
-                    self.mapping[idx] = results['items'][0]['id']
-                else:
-                    assert len(results['items']) == 0
-            return self.mapping[idx]
-
-    def new_block(self, idx, data=None):
-
-        with self.lock:
-
-            if idx >= self.block_count or idx < 0:
-                raise ValueError("Index out of bound")
-            if self.mapping[idx] is not None:
-                raise ValueError("None empty mapping @ {0}".format(idx))
-            if data is not None:
-                assert len(data) == self.block_size
-            else:
-                data = "\0" * self.block_size
-
-            body = {
-                'title': self.idx_to_name(idx),
-                'mimeType': self.BLOCK_MIMETYPE,
-                'parents': [{'id': self.data_dir}],
-            }
-            media_body = MediaInMemoryUpload(data, mimetype=self.BLOCK_MIMETYPE, resumable=False)
+    def digest(self, idx):
+        return self.layout.digest(idx)
 
-            result = self.drive.files().insert(body=body, media_body=media_body).execute()
-            self.mapping[idx] = result['id']
-            return result
+    def stop(self):
+        # Queued after whatever is left, so that still goes out
+        self.running = False
+        for worker in self.workers:
+            self.que.put(None, DeadlineQueue.PRI_BACKGROUND)
+        for worker in self.workers:
+            worker.join()
 
     def sync_io(self, idx, data, pri):
 
@@ -283,7 +445,7 @@ class GBD:
             ret.append(param)
             sem.release()
 
-        self.que.put((idx, data, mycb), pri)
+        self.que.put((idx, data, mycb, None), pri)
         sem.acquire()
 
         err, data = ret.pop()
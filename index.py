@@ -0,0 +1,92 @@
+#!/usr/bin/python2
+
+import json
+import zlib
+import struct
+
+class Index:
+
+    # A json header naming the tables, then the fixed-width records of each
+    # table, all compressed. Field types are I and Q for integers, s for a
+    # string, padded to the longest one in its table, and d for a sha1 hex
+    # digest or None.
+
+    MAGIC = "GBDI"
+    PREFIX = struct.Struct("!4sI")
+    # Records packed and compressed at a time
+    BATCH = 4096
+
+    @classmethod
+    def encode(cls, header, tables):
+
+        header = dict(header)
+        header['tables'] = []
+        body = zlib.compressobj()
+        chunks = []
+        for name, (fields, rows) in sorted(tables.iteritems()):
+            fmt = cls.format(fields, rows)
+            header['tables'].append([name, fields, fmt, len(rows)])
+            record = struct.Struct(fmt)
+            strings = [i for i, field in enumerate(fields) if field == 's']
+            digests = [i for i, field in enumerate(fields) if field == 'd']
+            for i in xrange(0, len(rows), cls.BATCH):
+                batch = rows[i:i + cls.BATCH]
+                if strings or digests:
+                    batch = [cls.pack_row(row, strings, digests) for row in batch]
+                chunks.append(body.compress(''.join(record.pack(*row) for row in batch)))
+        chunks.append(body.flush())
+
+        header = json.dumps(header)
+        return cls.PREFIX.pack(cls.MAGIC, len(header)) + header + ''.join(chunks)
+
+    @classmethod
+    def decode(cls, data):
+
+        magic, size = cls.PREFIX.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("Not an index")
+        header = json.loads(data[cls.PREFIX.size:cls.PREFIX.size + size])
+        body = zlib.decompress(data[cls.PREFIX.size + size:])
+
+        offset = 0
+        for name, fields, fmt, count in header.pop('tables'):
+            record = struct.Struct(fmt)
+            strings = [i for i, field in enumerate(fields) if field == 's']
+            digests = [i for i, field in enumerate(fields) if field == 'd']
+            rows = []
+            for i in xrange(count):
+                row = record.unpack_from(body, offset)
+                offset += record.size
+                if strings or digests:
+                    row = list(row)
+                    for j in strings:
+                        row[j] = row[j].rstrip("\0")
+                    for j in digests:
+                        row[j] = row[j].encode('hex') if row[j] != "\0" * 20 else None
+                rows.append(row)
+            header[name] = rows
+        return header
+
+    ## helper
+
+    @classmethod
+    def format(cls, fields, rows):
+        fmt = "!"
+        for i, field in enumerate(fields):
+            if field == 's':
+                fmt += "{0}s".format(max([len(row[i]) for row in rows] or [0]))
+            elif field == 'd':
+                fmt += "20s"
+            else:
+                fmt += field
+        return fmt
+
+    @classmethod
+    def pack_row(cls, row, strings, digests):
+        # Drive ids come back from json as unicode, struct only takes str
+        row = list(row)
+        for i in strings:
+            row[i] = str(row[i])
+        for i in digests:
+            row[i] = row[i].decode('hex') if row[i] is not None else "\0" * 20
+        return row
@@ -0,0 +1,86 @@
+#!/usr/bin/python2
+
+import os
+import struct
+import logging
+from threading import Lock
+
+logger = logging.getLogger('gbd')
+
+class Journal:
+
+    # op, cache entry, block idx, followed by the valid sector mask
+    RECORD = struct.Struct("!BIQ")
+
+    OP_MAP = 0
+    OP_UNMAP = 1
+    OP_DIRTY = 2
+    OP_CLEAN = 3
+    OP_VALID = 4
+
+    def __init__(self, path, uuid, mask_size):
+        self.path = path
+        self.uuid = uuid
+        self.mask_size = mask_size
+        self.record_size = self.RECORD.size + mask_size
+        self.count = 0
+        self.fout = None
+        # Held across a checkpoint so nothing is appended to a journal
+        # that is about to be replaced
+        self.lock = Lock()
+
+    ## interface
+
+    def replay(self):
+
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'rb') as fin:
+            if fin.read(len(self.uuid)) != self.uuid:
+                logger.warning("Journal `{0}' belongs to another cache, ignoring it".format(self.path))
+                return
+            while True:
+                record = fin.read(self.record_size)
+                # A torn record at the end was never acted upon
+                if len(record) < self.record_size:
+                    break
+                op, ent, idx = self.RECORD.unpack_from(record)
+                yield op, ent, idx, self.decode_mask(record[self.RECORD.size:])
+
+    def append(self, op, ent, idx, mask=0):
+        record = self.RECORD.pack(op, ent, idx) + self.encode_mask(mask)
+        with self.lock:
+            self.fout.write(record)
+            self.count += 1
+            return self.count
+
+    def reset(self, records):
+        # Called with the lock held, once the checkpoint the records
+        # complete is written
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            fout.write(self.uuid)
+            for op, ent, idx, mask in records:
+                fout.write(self.RECORD.pack(op, ent, idx) + self.encode_mask(mask))
+            fout.flush()
+            os.fsync(fout.fileno())
+        if self.fout is not None:
+            self.fout.close()
+        os.rename(tmp_path, self.path)
+        self.fout = open(self.path, 'ab', 0)
+        self.count = 0
+
+    def close(self):
+        with self.lock:
+            if self.fout is not None:
+                self.fout.close()
+                self.fout = None
+
+    ## helper
+
+    def encode_mask(self, mask):
+        return ('%0*x' % (self.mask_size * 2, mask)).decode('hex')
+
+    def decode_mask(self, data):
+        return int(data.encode('hex'), 16)
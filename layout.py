@@ -0,0 +1,685 @@
+#!/usr/bin/python2
+
+import time
+import json
+import struct
+import hashlib
+import logging
+from threading import Thread, Lock, Condition, Event
+from backend import RateLimitError
+from spares import SparePool
+
+logger = logging.getLogger('gbd')
+
+class Layout:
+
+    # Set when the index is the only record of where blocks live, so it has
+    # to be saved on every sync instead of only at a clean shutdown.
+    INDEX_ONLY = False
+    # Set when writes and trims go through the throttle on their own
+    OWN_THROTTLE = False
+
+    def __init__(self, gbd):
+        self.gbd = gbd
+        self.lock = gbd.lock
+        self.block_count = gbd.block_count
+        # Blocks the cache writes back at a time
+        self.write_depth = 8
+
+    ## interface
+
+    def load(self, backend, index):
+        raise NotImplementedError()
+
+    def dump(self):
+        raise NotImplementedError()
+
+    def dump_changes(self):
+        # What changed since the last dump, for INDEX_ONLY layouts
+        raise NotImplementedError()
+
+    def digest(self, idx):
+        raise NotImplementedError()
+
+    def read(self, backend, idx):
+        raise NotImplementedError()
+
+    def read_range(self, backend, idx, offset, length):
+        return self.read(backend, idx)[offset:offset + length]
+
+    def write(self, backend, idx, data):
+        raise NotImplementedError()
+
+    def trim(self, backend, idx):
+        raise NotImplementedError()
+
+    def collect(self, backend):
+        pass
+
+    def close(self):
+        pass
+
+    ## helper
+
+    def check_idx(self, idx):
+        if idx >= self.block_count or idx < 0:
+            raise IndexError("Can't map idx {0}".format(idx))
+
+class BlockLayout(Layout):
+
+    def __init__(self, gbd):
+        Layout.__init__(self, gbd)
+        self.mapping = [None] * self.block_count
+        self.digests = [None] * self.block_count
+        spare_blocks = gbd.config.get('spare_blocks', 0)
+        self.spares = SparePool(gbd, spare_blocks) if spare_blocks > 0 else None
+
+    ## interface
+
+    def load(self, backend, index):
+
+        if index is not None and index['clean']:
+            logger.info("Loading block index")
+            for idx, blkid, digest in index['mapping']:
+                self.mapping[idx] = blkid
+                self.digests[idx] = digest
+            return
+
+        if index is not None:
+            logger.warning("Block index is stale, rebuilding")
+        logger.info("Listing blocks")
+
+        for name, blkid in backend.list():
+            idx = self.name_to_idx(name)
+            if idx is None:
+                continue
+            if not 0 <= idx < self.block_count:
+                raise AssertionError("Block `{0}' out of bound".format(name))
+            if self.mapping[idx] is not None:
+                raise AssertionError("Block `{0}' is not unique".format(name))
+            self.mapping[idx] = blkid
+
+    def dump(self):
+        with self.lock:
+            return {}, {
+                'mapping': ('Isd', [(idx, blkid, self.digests[idx]) for idx, blkid in enumerate(self.mapping) if blkid is not None]),
+            }
+
+    def digest(self, idx):
+        if self.block_id(idx) is None:
+            return self.gbd.zero_digest
+        return self.digests[idx]
+
+    def read(self, backend, idx):
+        blkid = self.block_id(idx)
+        if blkid is None:
+            return self.gbd.zero_block
+        results = self.gbd.codec.decode(backend.read(blkid))
+        assert len(results) == self.gbd.block_size
+        self.digests[idx] = hashlib.sha1(results).hexdigest()
+        return results
+
+    def read_range(self, backend, idx, offset, length):
+        if not self.gbd.codec.seekable():
+            return Layout.read_range(self, backend, idx, offset, length)
+        blkid = self.block_id(idx)
+        if blkid is None:
+            return self.gbd.zero_block[offset:offset + length]
+        return backend.read(blkid, offset, length)
+
+    def write(self, backend, idx, data):
+        blkid = self.block_id(idx)
+        if blkid is None:
+            blkid = self.new_block(backend, idx, data)
+        else:
+            backend.write(blkid, self.gbd.codec.encode(data))
+        self.digests[idx] = hashlib.sha1(data).hexdigest()
+        return blkid
+
+    def trim(self, backend, idx):
+        blkid = self.block_id(idx)
+        if blkid is not None:
+            backend.delete(blkid)
+            with self.lock:
+                self.mapping[idx] = None
+                self.digests[idx] = None
+
+    def close(self):
+        if self.spares is not None:
+            self.spares.stop()
+
+    ## helper
+
+    @classmethod
+    def idx_to_name(cls, idx):
+        return "gbd_b" + str(idx)
+
+    @classmethod
+    def name_to_idx(cls, name):
+        if not name.startswith("gbd_b") or not name[5:].isdigit():
+            return None
+        return int(name[5:])
+
+    def block_id(self, idx):
+        self.check_idx(idx)
+        return self.mapping[idx]
+
+    def new_block(self, backend, idx, data):
+
+        # The cache has one request per block in flight, nobody else can map
+        # idx meanwhile, so the upload doesn't need the lock
+        if self.mapping[idx] is not None:
+            raise ValueError("None empty mapping @ {0}".format(idx))
+        assert len(data) == self.gbd.block_size
+
+        spare = self.spares.claim() if self.spares is not None else None
+        if spare is None:
+            blkid = backend.allocate(self.idx_to_name(idx), self.gbd.codec.encode(data))
+        else:
+            try:
+                blkid = backend.claim(spare, self.idx_to_name(idx), self.gbd.codec.encode(data))
+            except:
+                self.spares.unclaim(spare)
+                raise
+
+        with self.lock:
+            self.mapping[idx] = blkid
+        return blkid
+
+class ContentLayout(Layout):
+
+    INDEX_ONLY = True
+
+    def __init__(self, gbd):
+        Layout.__init__(self, gbd)
+        # logical index => content hash, content hash => [block id, refcount]
+        self.mapping = [None] * self.block_count
+        self.objects = {}
+        # logical index => content hash, since the last dump
+        self.changes = {}
+
+    ## interface
+
+    def load(self, backend, index):
+
+        if index is not None:
+            logger.info("Loading content index")
+            for digest, blkid in index['objects']:
+                self.objects[digest] = [blkid, 0]
+            for idx, digest in index['mapping']:
+                self.mapping[idx] = digest
+                self.objects[digest][1] += 1
+            for idx, digest, blkid in index['changes']:
+                if digest is not None and digest not in self.objects:
+                    self.objects[digest] = [blkid, 0]
+                self.link(idx, digest)
+            self.changes = {}
+            if index['clean']:
+                return
+            logger.warning("Content index is stale, writes after the last sync are lost")
+
+        # Objects uploaded after the index was saved are unreferenced,
+        # pick them up so the next collect() removes them. Unreferenced
+        # ones that are gone were collected after it was saved, nothing
+        # may link to those again.
+        found = set()
+        for name, blkid in backend.list():
+            digest = self.name_to_digest(name)
+            if digest is None:
+                continue
+            found.add(blkid)
+            if digest not in self.objects:
+                self.objects[digest] = [blkid, 0]
+        for digest, obj in self.objects.items():
+            if obj[1] == 0 and obj[0] not in found:
+                del self.objects[digest]
+
+    def dump(self):
+        with self.lock:
+            self.changes = {}
+            return {}, {
+                'mapping': ('Id', [(idx, digest) for idx, digest in enumerate(self.mapping) if digest is not None]),
+                'objects': ('ds', [(digest, obj[0]) for digest, obj in self.objects.iteritems()]),
+            }
+
+    def dump_changes(self):
+        # With the block id of every object they link to, the objects
+        # table may not have it yet
+        with self.lock:
+            changes, self.changes = self.changes, {}
+            return {}, {
+                'changes': ('Ids', [(idx, digest, self.objects[digest][0] if digest is not None else '') for idx, digest in sorted(changes.iteritems())]),
+            }
+
+    def digest(self, idx):
+        self.check_idx(idx)
+        return self.mapping[idx] or self.gbd.zero_digest
+
+    def read(self, backend, idx):
+        self.check_idx(idx)
+        with self.lock:
+            digest = self.mapping[idx]
+            if digest is None:
+                return self.gbd.zero_block
+            blkid = self.objects[digest][0]
+        results = self.gbd.codec.decode(backend.read(blkid))
+        assert len(results) == self.gbd.block_size
+        return results
+
+    def read_range(self, backend, idx, offset, length):
+        if not self.gbd.codec.seekable():
+            return Layout.read_range(self, backend, idx, offset, length)
+        self.check_idx(idx)
+        with self.lock:
+            digest = self.mapping[idx]
+            if digest is None:
+                return self.gbd.zero_block[offset:offset + length]
+            blkid = self.objects[digest][0]
+        return backend.read(blkid, offset, length)
+
+    def write(self, backend, idx, data):
+
+        self.check_idx(idx)
+        digest = hashlib.sha1(data).hexdigest()
+
+        with self.lock:
+            if self.mapping[idx] == digest:
+                return self.objects[digest][0]
+            if digest in self.objects:
+                logger.debug("Dedup {0} => {1}".format(idx, digest))
+                return self.link(idx, digest)
+
+        blkid = backend.allocate(self.digest_to_name(digest), self.gbd.codec.encode(data))
+
+        duplicate = None
+        with self.lock:
+            if digest in self.objects:
+                duplicate = blkid
+            else:
+                self.objects[digest] = [blkid, 0]
+            blkid = self.link(idx, digest)
+
+        # Someone else uploaded the same content meanwhile
+        if duplicate is not None:
+            backend.delete(duplicate)
+        return blkid
+
+    def trim(self, backend, idx):
+        self.check_idx(idx)
+        with self.lock:
+            self.link(idx, None)
+
+    def collect(self, backend):
+        with self.lock:
+            garbage = [digest for digest, obj in self.objects.iteritems() if obj[1] == 0]
+            if garbage:
+                logger.info("Removing {0} unreferenced objects".format(len(garbage)))
+            # Held across the deletes so a concurrent write can't revive an
+            # object that is about to disappear.
+            for digest in garbage:
+                backend.delete(self.objects[digest][0])
+                del self.objects[digest]
+
+    ## helper
+
+    @classmethod
+    def digest_to_name(cls, digest):
+        return "gbd_c" + digest
+
+    @classmethod
+    def name_to_digest(cls, name):
+        if not name.startswith("gbd_c") or len(name) != 45:
+            return None
+        return name[5:]
+
+    def link(self, idx, digest):
+        # None unlinks idx
+        obj = self.objects[digest] if digest is not None else [None, 0]
+        obj[1] += 1
+        self.unref(self.mapping[idx])
+        self.mapping[idx] = digest
+        self.changes[idx] = digest
+        return obj[0]
+
+    def unref(self, digest):
+        if digest is not None:
+            self.objects[digest][1] -= 1
+
+class PendingSegment:
+
+    def __init__(self):
+        # (idx, encoded block or None for a trim, where a copy came from)
+        self.entries = []
+        self.size = 0
+        self.sealed = False
+        self.done = Event()
+        self.error = None
+
+class SegmentLayout(Layout):
+
+    # Blocks written at about the same time are packed into one segment
+    # file, so the store sees a request per batch instead of one per block.
+    # Segments are never changed; every one ends with the table of the
+    # blocks it holds, so the mapping can be rebuilt from the segments
+    # written after the index was saved. The cleaner copies what is still
+    # live out of mostly overwritten segments and deletes them.
+
+    # Seconds the first block of a segment waits for others to join it
+    LINGER = 0.02
+    # Segments with less live data than this are cleaned
+    CLEAN_RATIO = 0.5
+    CLEAN_INTERVAL = 60.0
+    # Live bytes copied per cleaning pass, in segments
+    CLEAN_BUDGET = 4
+    TRAILER = struct.Struct("!Q")
+    # A segment is one request, however many blocks wait for it
+    OWN_THROTTLE = True
+    MAX_TRIES = 5
+
+    def __init__(self, gbd):
+        Layout.__init__(self, gbd)
+        # logical index => (segment, offset, length)
+        self.mapping = [None] * self.block_count
+        self.digests = [None] * self.block_count
+        # segment => [file id, size, live bytes]
+        self.segments = {}
+        self.next_seq = 0
+        # Segments being uploaded, the index can't vouch for those yet
+        self.uploading = set()
+        self.garbage = []
+        self.segment_size = gbd.config.get('segment_size', 8 << 20)
+        self.write_depth = max(self.write_depth, gbd.config.get('workers', 8))
+        self.open = None
+        self.pack_cv = Condition()
+        self.cleaning = Lock()
+        self.stop = Event()
+        self.cleaner = None
+
+    ## interface
+
+    def load(self, backend, index):
+
+        if index is not None:
+            logger.info("Loading segment index")
+            for seq, blkid, size in index['segments']:
+                self.segments[seq] = [blkid, size, 0]
+            for idx, seq, offset, length, digest in index['mapping']:
+                self.mapping[idx] = (seq, offset, length)
+                self.segments[seq][2] += length
+                # Replaying moves blocks the digests don't follow
+                if index['clean']:
+                    self.digests[idx] = digest
+            self.next_seq = index['next']
+
+        if index is None or not index['clean']:
+            if index is not None:
+                logger.warning("Segment index is stale, replaying newer segments")
+            found = []
+            for name, blkid in backend.list():
+                seq = self.name_to_seq(name)
+                if seq is not None:
+                    found.append((seq, blkid))
+            first = self.next_seq
+            for seq, blkid in sorted(found):
+                if seq >= first:
+                    self.replay(backend, seq, blkid)
+                elif seq not in self.segments:
+                    # Cleaned, the index saved after that no longer has it
+                    self.garbage.append(blkid)
+
+        self.cleaner = Thread(target=self.do_clean)
+        self.cleaner.daemon = True
+        self.cleaner.start()
+
+    def dump(self):
+        with self.lock:
+            return {'next': self.floor()}, {
+                'mapping': ('IQIId', [(idx,) + loc + (self.digests[idx],) for idx, loc in enumerate(self.mapping) if loc is not None]),
+                'segments': ('QsQ', [(seq, seg[0], seg[1]) for seq, seg in self.segments.iteritems()]),
+            }
+
+    def digest(self, idx):
+        self.check_idx(idx)
+        if self.mapping[idx] is None:
+            return self.gbd.zero_digest
+        return self.digests[idx]
+
+    def read(self, backend, idx):
+        results = self.gbd.codec.decode(self.fetch(backend, idx, 0, None))
+        assert len(results) == self.gbd.block_size
+        self.digests[idx] = hashlib.sha1(results).hexdigest()
+        return results
+
+    def read_range(self, backend, idx, offset, length):
+        if not self.gbd.codec.seekable():
+            return Layout.read_range(self, backend, idx, offset, length)
+        return self.fetch(backend, idx, offset, length)
+
+    def write(self, backend, idx, data):
+        self.check_idx(idx)
+        assert len(data) == self.gbd.block_size
+        self.commit(backend, idx, self.gbd.codec.encode(data))
+        self.digests[idx] = hashlib.sha1(data).hexdigest()
+
+    def trim(self, backend, idx):
+        self.check_idx(idx)
+        if self.mapping[idx] is not None:
+            self.commit(backend, idx, None)
+            self.digests[idx] = None
+
+    def collect(self, backend):
+        with self.cleaning:
+            self.clean(backend)
+
+    def close(self):
+        self.stop.set()
+        if self.cleaner is not None:
+            self.cleaner.join()
+
+    ## helper
+
+    @classmethod
+    def seq_to_name(cls, seq):
+        return "gbd_s{0:012d}".format(seq)
+
+    @classmethod
+    def name_to_seq(cls, name):
+        if not name.startswith("gbd_s") or not name[5:].isdigit():
+            return None
+        return int(name[5:])
+
+    def fetch(self, backend, idx, offset, length):
+        # What's stored for idx, or length bytes of it from offset
+        self.check_idx(idx)
+        while True:
+            with self.lock:
+                loc = self.mapping[idx]
+                if loc is None:
+                    return self.gbd.zero_block[offset:None if length is None else offset + length]
+                blkid = self.segments[loc[0]][0]
+            try:
+                return backend.read(blkid, loc[1] + offset, loc[2] - offset if length is None else length)
+            except Exception:
+                # The cleaner may have moved it and deleted the segment
+                with self.lock:
+                    if self.mapping[idx] == loc:
+                        raise
+
+    def floor(self):
+        # Every segment below this one is done, called with the lock held
+        return min(self.uploading) if self.uploading else self.next_seq
+
+    def commit(self, backend, idx, data):
+
+        # The first block in waits a little for others to join, then
+        # uploads the lot while they wait for it
+        with self.pack_cv:
+            seg = self.open
+            if seg is None:
+                seg = self.open = PendingSegment()
+            seg.entries.append((idx, data, None))
+            seg.size += len(data or '')
+            leader = len(seg.entries) == 1
+            if seg.size >= self.segment_size:
+                seg.sealed = True
+                self.open = None
+                self.pack_cv.notify_all()
+            elif leader:
+                deadline = time.time() + self.LINGER
+                while not seg.sealed and time.time() < deadline:
+                    self.pack_cv.wait(deadline - time.time())
+                if self.open is seg:
+                    seg.sealed = True
+                    self.open = None
+
+        if leader:
+            try:
+                self.upload(backend, seg)
+            except Exception as e:
+                seg.error = e
+            finally:
+                seg.done.set()
+        else:
+            seg.done.wait()
+        if seg.error is not None:
+            raise seg.error
+
+    def upload(self, backend, seg):
+
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.uploading.add(seq)
+
+        try:
+            body = []
+            table = []
+            offset = 0
+            for idx, data, src in seg.entries:
+                if data is None:
+                    table.append([idx, None, 0, src])
+                else:
+                    body.append(data)
+                    table.append([idx, offset, len(data), src])
+                    offset += len(data)
+            trailer = json.dumps({'blocks': table})
+            blkid = self.request(backend.allocate, self.seq_to_name(seq), ''.join(body) + trailer + self.TRAILER.pack(len(trailer)))
+            with self.lock:
+                self.segments[seq] = [blkid, offset, 0]
+                for entry in table:
+                    self.apply(seq, *entry)
+        finally:
+            with self.lock:
+                self.uploading.discard(seq)
+
+    def apply(self, seq, idx, offset, length, src):
+        # Called with the lock held, segments in the order they were written
+        old = self.mapping[idx]
+        if src is not None and (old is None or list(old[:2]) != src):
+            # Copied by the cleaner, but written again meanwhile
+            return
+        if old is not None:
+            self.segments[old[0]][2] -= old[2]
+        if offset is None:
+            self.mapping[idx] = None
+        else:
+            self.mapping[idx] = (seq, offset, length)
+            self.segments[seq][2] += length
+
+    def replay(self, backend, seq, blkid):
+        raw = backend.read(blkid)
+        try:
+            size = self.TRAILER.unpack(raw[-self.TRAILER.size:])[0]
+            table = json.loads(raw[-self.TRAILER.size - size:-self.TRAILER.size])['blocks']
+        except ValueError:
+            logger.warning("Segment {0} is damaged, skipped".format(seq))
+            return
+        logger.info("Replaying segment {0}".format(seq))
+        with self.lock:
+            if seq not in self.segments:
+                self.segments[seq] = [blkid, len(raw) - self.TRAILER.size - size, 0]
+            for entry in table:
+                self.apply(seq, *entry)
+            self.next_seq = max(self.next_seq, seq + 1)
+
+    def clean(self, backend):
+
+        with self.lock:
+            floor = self.floor()
+            # Segments only holding trims have nothing live from the start,
+            # the index saved below covers them
+            victims = sorted((seg[2], seq) for seq, seg in self.segments.iteritems()
+                    if seq < floor and (seg[1] == 0 or seg[2] < seg[1] * self.CLEAN_RATIO))
+
+        budget = self.segment_size * self.CLEAN_BUDGET
+        chosen = []
+        for live, seq in victims:
+            if live > budget:
+                break
+            budget -= live
+            chosen.append(seq)
+        if not chosen and not self.garbage:
+            return
+        logger.info("Cleaning {0} segments".format(len(chosen)))
+
+        # Everything still live in them goes into new segments
+        with self.lock:
+            lives = dict((seq, []) for seq in chosen)
+            for idx, loc in enumerate(self.mapping):
+                if loc is not None and loc[0] in lives:
+                    lives[loc[0]].append((idx, loc))
+        seg = PendingSegment()
+        for seq in chosen:
+            if not lives[seq]:
+                continue
+            raw = self.request(backend.read, self.segments[seq][0])
+            for idx, (_, offset, length) in lives[seq]:
+                seg.entries.append((idx, raw[offset:offset + length], [seq, offset]))
+                seg.size += length
+            if seg.size >= self.segment_size:
+                self.upload(backend, seg)
+                seg = PendingSegment()
+        if seg.entries:
+            self.upload(backend, seg)
+
+        with self.lock:
+            for seq in chosen:
+                if self.segments[seq][2] == 0:
+                    self.garbage.append(self.segments.pop(seq)[0])
+            garbage = self.garbage
+            self.garbage = []
+
+        # Only once the index no longer points there
+        self.gbd.save_index(clean=False)
+        for blkid in garbage:
+            try:
+                self.request(backend.delete, blkid)
+            except Exception as e:
+                logger.warning("Can't remove segment {0}: {1}".format(blkid, repr(e)))
+                with self.lock:
+                    self.garbage.append(blkid)
+
+    def request(self, fn, *args):
+        # Uploads and the cleaner's requests share the throttle with the
+        # workers, and back off like them
+        for rnd in xrange(self.MAX_TRIES):
+            if not self.gbd.throttle.acquire(retry=rnd > 0):
+                raise RateLimitError('retryBudgetExhausted')
+            throttled = False
+            try:
+                return fn(*args)
+            except RateLimitError as e:
+                throttled = True
+                if rnd + 1 == self.MAX_TRIES:
+                    raise
+                logger.warning("Backoff ({0})".format(e.reason))
+            finally:
+                self.gbd.throttle.release(throttled)
+
+    def do_clean(self):
+        backend = self.gbd.backend.clone()
+        while not self.stop.wait(self.CLEAN_INTERVAL):
+            try:
+                self.collect(backend)
+            except Exception as e:
+                logger.warning("Cleaning failed: {0}".format(repr(e)))
@@ -0,0 +1,245 @@
+#!/usr/bin/python2
+
+import os
+import logging
+import bisect
+import SocketServer
+import BaseHTTPServer
+from threading import Thread, Lock
+
+logger = logging.getLogger('gbd')
+
+class Metric:
+
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values => value, or a function returning it
+        self.values = {}
+        self.lock = Lock()
+
+    ## interface
+
+    def track(self, fn, **labels):
+        # Read fn() whenever the metric is collected
+        with self.lock:
+            self.values[self.key(labels)] = fn
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def collect(self):
+        with self.lock:
+            items = self.values.items()
+        lines = []
+        for key, value in sorted(items):
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    logger.warning("Can't collect {0}: {1}".format(self.name, e))
+                    continue
+            lines.extend(self.format(key, value))
+        return lines
+
+    ## helper
+
+    def key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("{0} takes labels {1}".format(self.name, self.labels))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def format(self, key, value, suffix='', extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        labels = ','.join('{0}="{1}"'.format(name, escape(value)) for name, value in pairs)
+        return ["{0}{1}{2} {3}".format(self.name, suffix, '{' + labels + '}' if labels else '', number(value))]
+
+class Counter(Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+
+    # Seconds, from a local disk hit up to drive having a bad day
+    BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # per bucket counts, the last one past every bound, then sum
+                self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def format(self, key, value):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value):
+            total += count
+            lines.extend(Metric.format(self, key, total, '_bucket', [('le', number(bound))]))
+        lines.extend(Metric.format(self, key, value[-1], '_sum'))
+        lines.extend(Metric.format(self, key, total, '_count'))
+        return lines
+
+    def collect(self):
+        # Copy the counts so they are consistent with each other
+        with self.lock:
+            items = [(key, list(value)) for key, value in self.values.items()]
+        lines = []
+        for key, value in sorted(items):
+            lines.extend(self.format(key, value))
+        return lines
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    ## interface
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        return self.register(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.append("# HELP {0} {1}".format(name, metric.help))
+            lines.append("# TYPE {0} {1}".format(name, metric.TYPE))
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+    ## helper
+
+    def register(self, cls, name, help, labels, *args):
+        # Every instance of a component shares the metric, the labels
+        # tell them apart
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, *args)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError("Metric `{0}' registered twice with different types".format(name))
+            return metric
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', self.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return str(self.client_address or 'local')
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics: " + format % args)
+
+class TCPMetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixMetricsServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+class MetricsServer:
+
+    def __init__(self, address, registry=None):
+
+        # host:port for http over tcp, anything else is a unix socket path
+        self.registry = registry or REGISTRY
+        host, _, port = address.rpartition(':')
+        if port.isdigit() and '/' not in address:
+            self.server = TCPMetricsServer((host or '127.0.0.1', int(port)), MetricsHandler)
+        else:
+            self.server = UnixMetricsServer(address, MetricsHandler)
+        self.server.registry = self.registry
+        self.address = address
+
+    ## interface
+
+    def start(self):
+        logger.info("Serving metrics on {0}".format(self.address))
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.server, UnixMetricsServer) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+## helper
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+REGISTRY = Registry()
@@ -1,12 +1,16 @@
 #!/usr/bin/python2
 
 import os
-import sys
 import struct
 import socket
 import traceback
+import time
 import logging
+from threading import Thread, Lock, Condition, Event
 from cached_gbd import CachedGBD
+from config import Config
+from metrics import REGISTRY, MetricsServer
+from tracing import TRACER, RequestRecorder
 
 logger = logging.getLogger('gbd')
 
@@ -15,13 +19,28 @@ class NBDService:
     NBD_REQ_MAGIC = struct.pack("!I", 0x25609513)
     NBD_RPY_MAGIC = struct.pack("!I", 0x67446698)
 
+    REQUEST = struct.Struct("!4sI8sQI")
+    REPLY = struct.Struct("!4sI8s")
+
     NBD_REQ_MASK = 0xffff
     NBD_REQ_FLAG_MASK = 0xffff0000
     NBD_CMD_READ = 0
     NBD_CMD_WRITE = 1
     NBD_CMD_DISC = 2
     NBD_CMD_FLUSH = 3
-    #NBD_CMD_TRIM = 4
+    NBD_CMD_TRIM = 4
+    NBD_CMD_WRITE_ZEROES = 6
+
+    NBD_CMD_NAMES = {
+        NBD_CMD_READ: 'read',
+        NBD_CMD_WRITE: 'write',
+        NBD_CMD_FLUSH: 'flush',
+        NBD_CMD_TRIM: 'trim',
+        NBD_CMD_WRITE_ZEROES: 'write_zeroes',
+    }
+
+    NBD_CMD_FLAG_FUA = 1 << 16
+    NBD_CMD_FLAG_NO_HOLE = 1 << 17
 
     NBD_ERR_PERM = 1
     NBD_ERR_IO = 5
@@ -29,34 +48,60 @@ class NBDService:
     NBD_ERR_INVAL = 22
     NBD_ERR_NOSPC = 28
 
-    def __init__(self, conn, gbd):
+    def __init__(self, conn, gbd, recorder=None):
         self.conn = conn
         self.gbd = gbd
+        self.recorder = recorder
+        self.send_lock = Lock()
+        self.header = bytearray(self.REQUEST.size)
+        # Requests not replied yet, handle => (command, start time, trace)
+        self.cv = Condition()
+        self.pending = 0
+        self.started = {}
+        self.latency = REGISTRY.histogram('gbd_nbd_request_seconds', 'Time from receiving an nbd request to replying', ('device', 'command'))
+        self.errors = REGISTRY.counter('gbd_nbd_errors_total', 'Nbd requests replied with an error', ('device', 'command'))
 
     def serve(self):
 
         while True:
 
-            cmd, handle, offset, length, data = self.get_request()
-            seq = "%016x" % struct.unpack("!Q", handle)[0]
+            try:
+                cmd, flags, handle, offset, length, data = self.get_request()
+            except IOError as e:
+                logger.warning("Connection lost: {0}".format(e))
+                cmd = self.NBD_CMD_DISC
 
             if cmd == self.NBD_CMD_DISC:
                 logger.info("Disconnect")
-                self.gbd.end()
-                sys.exit(0)
+                # Other connections may still use the export, just let
+                # whatever we started finish
+                with self.cv:
+                    while self.pending > 0:
+                        self.cv.wait()
+                return
+
+            fua = bool(flags & self.NBD_CMD_FLAG_FUA)
+            seq = "%016x" % struct.unpack("!Q", handle)[0]
+            command = self.NBD_CMD_NAMES.get(cmd, 'unknown')
+            trace = TRACER.start(command, offset=offset, length=length)
+            with self.cv:
+                self.pending += 1
+                self.started[handle] = (command, time.time(), trace)
 
             if cmd == self.NBD_CMD_READ:
                 logger.debug("{0}: Read {1} {2}".format(seq, offset, length))
-                def gcb(handle, seq):
-                    def cb(err, data):
+                # The data lands right behind the reply header
+                reply = bytearray(self.REPLY.size + length)
+                def gcb(handle, seq, reply):
+                    def cb(err, _):
                         if err:
-                            logger.error("{0}: Read failed: {1}".format(seq, e))
+                            logger.error("{0}: Read failed: {1}".format(seq, err))
                             self.send_reply(self.NBD_ERR_IO, handle)
                         else:
                             logger.debug("{0}: Read end".format(seq))
-                            self.send_reply(0, handle, data)
+                            self.send_reply(0, handle, reply)
                     return cb
-                self.gbd.read(offset, length, callback=gcb(handle, seq))
+                self.gbd.read(offset, length, callback=gcb(handle, seq, reply), buf=memoryview(reply)[self.REPLY.size:], trace=trace)
 
             elif cmd == self.NBD_CMD_WRITE:
                 logger.debug("{0}: Write {1} {2}".format(seq, offset, length))
@@ -64,17 +109,39 @@ class NBDService:
                 def gcb(handle, seq):
                     def cb(err):
                         if err:
-                            logger.error("{0}: Write failed: {1}".format(seq, e))
+                            logger.error("{0}: Write failed: {1}".format(seq, err))
                             self.send_reply(self.NBD_ERR_IO, handle)
                         else:
                             logger.debug("{0}: Write end".format(seq))
                             self.send_reply(0, handle)
                     return cb
-                self.gbd.write(offset, data, callback=gcb(handle, seq))
+                self.gbd.write(offset, data, callback=gcb(handle, seq), fua=fua, trace=trace)
+
+            elif cmd == self.NBD_CMD_TRIM or cmd == self.NBD_CMD_WRITE_ZEROES:
+                logger.debug("{0}: Trim {1} {2}".format(seq, offset, length))
+                def gcb(handle, seq):
+                    def cb(err):
+                        if err:
+                            logger.error("{0}: Trim failed: {1}".format(seq, err))
+                            self.send_reply(self.NBD_ERR_IO, handle)
+                        else:
+                            logger.debug("{0}: Trim end".format(seq))
+                            self.send_reply(0, handle)
+                    return cb
+                self.gbd.trim(offset, length, callback=gcb(handle, seq), fua=fua, trace=trace)
 
             elif cmd == self.NBD_CMD_FLUSH:
                 logger.debug("{0}: Flush".format(seq))
-                self.send_reply(0, handle)
+                def gcb(handle, seq):
+                    def cb(err):
+                        if err:
+                            logger.error("{0}: Flush failed: {1}".format(seq, err))
+                            self.send_reply(self.NBD_ERR_IO, handle)
+                        else:
+                            logger.debug("{0}: Flush end".format(seq))
+                            self.send_reply(0, handle)
+                    return cb
+                self.gbd.flush(callback=gcb(handle, seq))
 
             else:
                 logger.error("{0}: Unknown command {1}".format(seq, cmd))
@@ -82,30 +149,60 @@ class NBDService:
 
     def get_request(self):
 
-        magic = self.conn.recv(4, socket.MSG_WAITALL)
-        type = struct.unpack("!I", self.conn.recv(4, socket.MSG_WAITALL))[0]
-        handle = self.conn.recv(8, socket.MSG_WAITALL)
-        offset = struct.unpack("!Q", self.conn.recv(8, socket.MSG_WAITALL))[0]
-        length = struct.unpack("!I", self.conn.recv(4, socket.MSG_WAITALL))[0]
+        self.recv_all(memoryview(self.header))
+        magic, type, handle, offset, length = self.REQUEST.unpack_from(self.header)
         data = None
 
         assert magic == self.NBD_REQ_MAGIC
-        assert (type & self.NBD_REQ_FLAG_MASK) == 0
 
         cmd = type & self.NBD_REQ_MASK
+        flags = type & self.NBD_REQ_FLAG_MASK
+        if cmd == self.NBD_CMD_WRITE_ZEROES:
+            # Zeroed blocks are never stored, so there is no hole to avoid
+            assert (flags & ~(self.NBD_CMD_FLAG_FUA | self.NBD_CMD_FLAG_NO_HOLE)) == 0
+        elif cmd == self.NBD_CMD_WRITE or cmd == self.NBD_CMD_TRIM:
+            assert (flags & ~self.NBD_CMD_FLAG_FUA) == 0
+        else:
+            assert flags == 0
         if cmd == self.NBD_CMD_FLUSH:
             assert offset == 0 and length == 0
         elif cmd == self.NBD_CMD_WRITE:
-            data = self.conn.recv(length, socket.MSG_WAITALL)
-
-        return (cmd, handle, offset, length, data)
-
-    def send_reply(self, error, handle, data=None):
-        self.conn.send(self.NBD_RPY_MAGIC)
-        self.conn.send(struct.pack("!I", error))
-        self.conn.send(handle)
-        if data:
-            self.conn.send(data)
+            data = bytearray(length)
+            self.recv_all(memoryview(data))
+
+        if self.recorder is not None:
+            self.recorder.record(self.header, data)
+
+        return (cmd, flags, handle, offset, length, data)
+
+    def recv_all(self, buf):
+        while len(buf):
+            size = self.conn.recv_into(buf, len(buf), socket.MSG_WAITALL)
+            if size == 0:
+                raise IOError("Connection closed")
+            buf = buf[size:]
+
+    def send_reply(self, error, handle, reply=None):
+        # Replies carrying data come with room for the header in front
+        if reply is None:
+            reply = bytearray(self.REPLY.size)
+        self.REPLY.pack_into(reply, 0, self.NBD_RPY_MAGIC, error, handle)
+        with self.cv:
+            command, start, trace = self.started.pop(handle)
+        if trace is not None:
+            trace.mark('reply')
+        try:
+            with self.send_lock:
+                self.conn.sendall(reply)
+        finally:
+            with self.cv:
+                self.pending -= 1
+                self.cv.notify_all()
+            self.latency.observe(time.time() - start, device=self.gbd.name, command=command)
+            if error:
+                self.errors.inc(device=self.gbd.name, command=command)
+            if trace is not None:
+                trace.finish()
 
 class NBDServer:
 
@@ -113,6 +210,19 @@ class NBDServer:
 
     NBD_OPT_EXPORT_NAME = 1
     NBD_OPT_ABORT = 2
+    NBD_OPT_LIST = 3
+    NBD_OPT_INFO = 6
+    NBD_OPT_GO = 7
+
+    NBD_REP_MAGIC = struct.pack("!Q", 0x3e889045565a9)
+    NBD_REP_ACK = 1
+    NBD_REP_SERVER = 2
+    NBD_REP_INFO = 3
+    NBD_REP_ERR_UNSUP = (1 << 31) + 1
+    NBD_REP_ERR_INVALID = (1 << 31) + 3
+
+    NBD_INFO_EXPORT = 0
+    NBD_INFO_BLOCK_SIZE = 3
 
     NBD_FLAG_HAS_FLAGS = 1 << 0
     NBD_FLAG_READ_ONLY = 1 << 1
@@ -120,6 +230,8 @@ class NBDServer:
     NBD_FLAG_SEND_FUA = 1 << 3
     NBD_FLAG_ROTATIONAL = 1 << 4
     NBD_FLAG_SEND_TRIM = 1 << 5
+    NBD_FLAG_SEND_WRITE_ZEROES = 1 << 6
+    NBD_FLAG_CAN_MULTI_CONN = 1 << 8
 
     NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
     NBD_FLAG_NO_ZEROES = 1 << 1
@@ -129,7 +241,10 @@ class NBDServer:
 
     GBD_NAME_FMT = "gbd-{0}"
 
-    def __init__(self, create=False, host='0.0.0.0', port=10809):
+    # Largest request we tell clients to send
+    MAX_PAYLOAD = 32 << 20
+
+    def __init__(self, create=False, host='0.0.0.0', port=10809, metrics_address=None, record_path=None):
 
         self.create = create
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -137,20 +252,44 @@ class NBDServer:
         self.sock.bind((host, port))
         self.sock.listen(4)
 
+        # name => [gbd, connections], every connection to an export shares it
+        self.exports = {}
+        # name => set once the export's last client is done closing it
+        self.closing = {}
+        # name => set once the export's first client is done opening it
+        self.opening = {}
+        self.lock = Lock()
+
+        # host:port or the path of a unix socket to serve metrics on
+        self.metrics = MetricsServer(metrics_address) if metrics_address else None
+        # Every request of every connection, for bench.py --replay
+        self.recorder = RequestRecorder(record_path) if record_path else None
+
     def run(self):
 
-        while True:
+        if self.metrics is not None:
+            self.metrics.start()
 
+        while True:
             conn, addr = self.sock.accept()
-            if os.fork() != 0:
-                conn.close()
-                continue
-
-            #self.sock.close()
-            logger.info("Accept client from {0}".format(addr))
-            conn, gbd = self.handshake(conn)
-            NBDService(conn, gbd).serve()
-            sys.exit(0)
+            client = Thread(target=self.serve_client, args=(conn, addr))
+            client.daemon = True
+            client.start()
+
+    def serve_client(self, conn, addr):
+
+        logger.info("Accept client from {0}".format(addr))
+        try:
+            conn, name, gbd = self.handshake(conn)
+            if gbd is not None:
+                try:
+                    NBDService(conn, gbd, self.recorder).serve()
+                finally:
+                    self.close_export(name)
+        except Exception as e:
+            logger.error("Client {0} failed: {1}".format(addr, repr(e)))
+        finally:
+            conn.close()
 
     def handshake(self, conn):
 
@@ -159,23 +298,139 @@ class NBDServer:
         conn.send(struct.pack("!H", self.NBD_FLAG_FIXED_NEWSTYLE | self.NBD_FLAG_NO_ZEROES))
 
         cliopt = struct.unpack("!I", conn.recv(4, socket.MSG_WAITALL))[0]
-        assert conn.recv(8, socket.MSG_WAITALL) == self.MAGIC
+        c_fixed = cliopt & self.NBD_FLAG_C_FIXED_NEWSTYLE
         c_no_zero = cliopt & self.NBD_FLAG_C_NO_ZEROS
 
-        option = struct.unpack("!I", conn.recv(4, socket.MSG_WAITALL))[0]
-        assert option == self.NBD_OPT_EXPORT_NAME
-        
-        length = struct.unpack("!I", conn.recv(4, socket.MSG_WAITALL))[0]
-        name = conn.recv(length, socket.MSG_WAITALL)
+        # Exports opened during the handshake, closed again unless handed
+        # to the service, also kept from NBD_OPT_INFO for a following
+        # NBD_OPT_GO
+        gbds = {}
 
-        gbd = self.get_gbd(name)
+        try:
+            while True:
 
-        conn.send(struct.pack("!Q", gbd.total_size))
-        conn.send(struct.pack("!H", 0))
-        if not c_no_zero:
-            conn.send("\0" * 124)
+                assert conn.recv(8, socket.MSG_WAITALL) == self.MAGIC
+                option, length = struct.unpack("!II", conn.recv(8, socket.MSG_WAITALL))
+                data = conn.recv(length, socket.MSG_WAITALL) if length else ''
+                assert len(data) == length
 
-        return conn, gbd
+                if option == self.NBD_OPT_EXPORT_NAME:
+                    gbd = gbds[data] = gbds.get(data) or self.open_export(data)
+                    conn.sendall(struct.pack("!QH", gbd.total_size, self.transmission_flags()))
+                    if not c_no_zero:
+                        conn.sendall("\0" * 124)
+                    return conn, data, gbds.pop(data)
+
+                # Without fixed newstyle the client can't take option replies
+                assert c_fixed
+
+                if option == self.NBD_OPT_ABORT:
+                    logger.info("Client aborted")
+                    self.send_option_reply(conn, option, self.NBD_REP_ACK)
+                    return conn, None, None
+
+                elif option == self.NBD_OPT_LIST:
+                    for name in self.list_exports():
+                        self.send_option_reply(conn, option, self.NBD_REP_SERVER, struct.pack("!I", len(name)) + name)
+                    self.send_option_reply(conn, option, self.NBD_REP_ACK)
+
+                elif option == self.NBD_OPT_INFO or option == self.NBD_OPT_GO:
+                    request = self.parse_info_request(data)
+                    if request is None:
+                        self.send_option_reply(conn, option, self.NBD_REP_ERR_INVALID)
+                        continue
+                    name, infos = request
+                    gbd = gbds[name] = gbds.get(name) or self.open_export(name)
+                    self.send_option_reply(conn, option, self.NBD_REP_INFO,
+                            struct.pack("!HQH", self.NBD_INFO_EXPORT, gbd.total_size, self.transmission_flags()))
+                    if self.NBD_INFO_BLOCK_SIZE in infos:
+                        self.send_option_reply(conn, option, self.NBD_REP_INFO,
+                                struct.pack("!HIII", self.NBD_INFO_BLOCK_SIZE, *self.block_size_hints(gbd)))
+                    self.send_option_reply(conn, option, self.NBD_REP_ACK)
+                    if option == self.NBD_OPT_GO:
+                        return conn, name, gbds.pop(name)
+
+                else:
+                    logger.warning("Unsupported option {0}".format(option))
+                    self.send_option_reply(conn, option, self.NBD_REP_ERR_UNSUP)
+
+        finally:
+            for name in gbds:
+                self.close_export(name)
+
+    def send_option_reply(self, conn, option, reply, data=''):
+        conn.sendall(self.NBD_REP_MAGIC + struct.pack("!III", option, reply, len(data)) + data)
+
+    def parse_info_request(self, data):
+        if len(data) < 4:
+            return None
+        length = struct.unpack_from("!I", data)[0]
+        if len(data) < 6 + length:
+            return None
+        name = data[4:4 + length]
+        count = struct.unpack_from("!H", data, 4 + length)[0]
+        if len(data) != 6 + length + 2 * count:
+            return None
+        return name, struct.unpack_from("!%dH" % count, data, 6 + length)
+
+    def transmission_flags(self):
+        # A flush covers writes from every connection, so they may be spread
+        return (self.NBD_FLAG_HAS_FLAGS | self.NBD_FLAG_SEND_FLUSH | self.NBD_FLAG_SEND_FUA |
+                self.NBD_FLAG_SEND_TRIM | self.NBD_FLAG_SEND_WRITE_ZEROES | self.NBD_FLAG_CAN_MULTI_CONN)
+
+    def block_size_hints(self, gbd):
+        # Sector sized requests are fine, whole blocks avoid fetching the
+        # rest of the block before it can be written back
+        minimum = gbd.sector_size if gbd.sector_size == gbd.SECTOR else 1
+        preferred = gbd.block_size
+        maximum = max(preferred, self.MAX_PAYLOAD // preferred * preferred)
+        return minimum, preferred, maximum
+
+    def list_exports(self):
+        prefix = self.GBD_NAME_FMT.format('')
+        return sorted(name[len(prefix):] for name in os.listdir('.') if name.startswith(prefix) and os.path.isfile(name))
+
+    def open_export(self, name):
+        while True:
+            with self.lock:
+                # The last client just left, its cache file is ours once
+                # it's done, or another client is opening it
+                busy = self.closing.get(name) or self.opening.get(name)
+                if busy is None:
+                    export = self.exports.get(name)
+                    if export is not None:
+                        export[1] += 1
+                        return export[0]
+                    opening = self.opening[name] = Event()
+                    break
+            busy.wait()
+        # Opening loads the cache and the index, other exports can't wait on that
+        try:
+            gbd = self.get_gbd(name)
+            with self.lock:
+                self.exports[name] = [gbd, 1]
+            return gbd
+        finally:
+            with self.lock:
+                del self.opening[name]
+            opening.set()
+
+    def close_export(self, name):
+        with self.lock:
+            export = self.exports[name]
+            export[1] -= 1
+            if export[1] > 0:
+                return
+            del self.exports[name]
+            closing = self.closing[name] = Event()
+        # Ending syncs everything, other exports can't wait on that
+        try:
+            logger.info("Closing export {0}".format(name))
+            export[0].end()
+        finally:
+            with self.lock:
+                del self.closing[name]
+            closing.set()
 
     def get_gbd(self, name):
 
@@ -196,4 +451,6 @@ if __name__ == "__main__":
 
     logging.basicConfig()
     logger.setLevel(logging.DEBUG)
-    NBDServer(create=True).run()
+    if Config.get('trace_path'):
+        TRACER.open(Config['trace_path'], Config.get('trace_rate', 0.01))
+    NBDServer(create=True, metrics_address=Config.get('metrics_address'), record_path=Config.get('record_path')).run()
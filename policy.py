@@ -0,0 +1,279 @@
+#!/usr/bin/python2
+
+import time
+import logging
+from collections import OrderedDict
+from threading import Condition
+from util import RLUQueue
+
+logger = logging.getLogger('gbd')
+
+class Policy:
+
+    # Holds the cache entries that may be evicted. An entry taken out with
+    # pop() keeps its place in the policy's bookkeeping until it is put
+    # back, or until get() or unget() hands it out for another block.
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = [None] * size
+        self.free = RLUQueue(size)
+        self.count = 0
+        self.cv = Condition()
+        self.ghost_hits = 0
+
+    ## interface
+
+    def put(self, obj, key, hit=False):
+        with self.cv:
+            if self.keys[obj] != key:
+                self.forget(obj)
+                self.keys[obj] = key
+                self.admit(obj, key)
+            else:
+                self.reference(obj, hit)
+            self.count += 1
+            self.cv.notify()
+
+    def get(self, key=None):
+        with self.cv:
+            while self.count == 0:
+                self.cv.wait()
+            self.count -= 1
+            if key is not None:
+                self.miss(key)
+            obj = self.free.get(block=False)
+            if obj is None:
+                obj = self.victim()
+                self.forget(obj)
+                self.keys[obj] = None
+            return obj
+
+    def unget(self, obj):
+        with self.cv:
+            self.forget(obj)
+            self.keys[obj] = None
+            self.free.unget(obj)
+            self.count += 1
+            self.cv.notify()
+
+    def pop(self, obj):
+        with self.cv:
+            if self.free.pop(obj) is None and not self.remove(obj):
+                return None
+            self.count -= 1
+            return obj
+
+    def extend(self, objs, keys=None):
+        with self.cv:
+            objs = list(objs)
+            if keys is None:
+                self.free.extend(objs)
+            else:
+                for obj, key in zip(objs, keys):
+                    self.keys[obj] = key
+                    self.admit(obj, key)
+            self.count += len(objs)
+            self.cv.notify_all()
+
+    def empty(self):
+        with self.cv:
+            return self.count == 0
+
+    def __len__(self):
+        return self.count
+
+    ## hooks, called with cv held
+
+    def admit(self, obj, key):
+        # obj now holds key and may be evicted
+        raise NotImplementedError()
+
+    def reference(self, obj, hit):
+        # obj holds the same key as before and may be evicted again
+        raise NotImplementedError()
+
+    def remove(self, obj):
+        # Take obj out of the evictable lists, False if it wasn't there
+        raise NotImplementedError()
+
+    def forget(self, obj):
+        # obj no longer holds its key
+        pass
+
+    def miss(self, key):
+        pass
+
+    def victim(self):
+        # Remove and return the entry to evict, there is at least one
+        raise NotImplementedError()
+
+class LRUPolicy(Policy):
+
+    def __init__(self, size):
+        Policy.__init__(self, size)
+        self.lru = RLUQueue(size)
+
+    def admit(self, obj, key):
+        self.lru.put(obj)
+
+    def reference(self, obj, hit):
+        self.lru.put(obj)
+
+    def remove(self, obj):
+        return self.lru.pop(obj) is not None
+
+    def victim(self):
+        return self.lru.get(block=False)
+
+class TwoQPolicy(Policy):
+
+    # Full 2Q: new blocks go through a FIFO (a1in) and only make it to the
+    # LRU (am) when they come back after being evicted from it, which a
+    # scan never does. Re-reads while still in the FIFO don't count, so the
+    # correlated hits of a sequential reader don't promote anything.
+
+    IN, AM = 1, 2
+
+    def __init__(self, size, kin=0.25, kout=0.5):
+        Policy.__init__(self, size)
+        self.kin = max(1, int(size * kin))
+        self.kout = max(1, int(size * kout))
+        self.a1in = RLUQueue(size)
+        self.am = RLUQueue(size)
+        self.a1out = OrderedDict()
+        self.where = [None] * size
+        self.in_count = 0
+        self.promote = set()
+
+    def admit(self, obj, key):
+        if key in self.promote:
+            self.promote.discard(key)
+            self.where[obj] = self.AM
+            self.am.put(obj)
+        else:
+            self.where[obj] = self.IN
+            self.in_count += 1
+            self.a1in.put(obj)
+
+    def reference(self, obj, hit):
+        if self.where[obj] == self.AM:
+            self.am.put(obj)
+        else:
+            self.a1in.put(obj)
+
+    def remove(self, obj):
+        queue = self.am if self.where[obj] == self.AM else self.a1in
+        return queue.pop(obj) is not None
+
+    def forget(self, obj):
+        if self.where[obj] == self.IN:
+            self.in_count -= 1
+        self.where[obj] = None
+
+    def miss(self, key):
+        if key in self.a1out:
+            del self.a1out[key]
+            self.ghost_hits += 1
+            self.promote.add(key)
+
+    def victim(self):
+        if self.in_count > self.kin or self.am.empty():
+            obj = self.a1in.get(block=False)
+            if obj is not None:
+                self.a1out[self.keys[obj]] = None
+                while len(self.a1out) > self.kout:
+                    self.a1out.popitem(last=False)
+                return obj
+        obj = self.am.get(block=False)
+        return obj if obj is not None else self.a1in.get(block=False)
+
+class ARCPolicy(Policy):
+
+    # Adaptive replacement cache, t1 holds blocks seen once and t2 blocks
+    # seen again, with the split between them tuned by ghost hits. Re-reads
+    # within CORRELATION seconds of the block coming in are the same access
+    # as far as t2 is concerned, or any sequential reader smaller than a
+    # block would promote everything it reads.
+
+    T1, T2 = 1, 2
+    CORRELATION = 1.0
+
+    def __init__(self, size):
+        Policy.__init__(self, size)
+        self.p = 0
+        self.t1 = RLUQueue(size)
+        self.t2 = RLUQueue(size)
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.where = [None] * size
+        self.admitted = [0] * size
+        self.sizes = {self.T1: 0, self.T2: 0}
+        self.promote = set()
+        self.from_b2 = False
+
+    def admit(self, obj, key):
+        where = self.T2 if key in self.promote else self.T1
+        self.promote.discard(key)
+        self.where[obj] = where
+        self.sizes[where] += 1
+        self.admitted[obj] = time.time()
+        (self.t2 if where == self.T2 else self.t1).put(obj)
+
+    def reference(self, obj, hit):
+        if hit and self.where[obj] == self.T1 and time.time() - self.admitted[obj] > self.CORRELATION:
+            self.sizes[self.T1] -= 1
+            self.sizes[self.T2] += 1
+            self.where[obj] = self.T2
+        (self.t2 if self.where[obj] == self.T2 else self.t1).put(obj)
+
+    def remove(self, obj):
+        queue = self.t2 if self.where[obj] == self.T2 else self.t1
+        return queue.pop(obj) is not None
+
+    def forget(self, obj):
+        if self.where[obj] is not None:
+            self.sizes[self.where[obj]] -= 1
+        self.where[obj] = None
+
+    def miss(self, key):
+        self.from_b2 = False
+        if key in self.b1:
+            self.p = min(self.size, self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            self.ghost_hits += 1
+            self.promote.add(key)
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            self.ghost_hits += 1
+            self.promote.add(key)
+            self.from_b2 = True
+        else:
+            # Keep the directory at twice the cache size
+            t1 = self.sizes[self.T1]
+            if t1 + len(self.b1) >= self.size and self.b1:
+                self.b1.popitem(last=False)
+            elif t1 + self.sizes[self.T2] + len(self.b1) + len(self.b2) >= 2 * self.size and self.b2:
+                self.b2.popitem(last=False)
+
+    def victim(self):
+        t1 = self.sizes[self.T1]
+        if t1 > 0 and (t1 > self.p or (self.from_b2 and t1 == self.p)):
+            order = [(self.t1, self.b1), (self.t2, self.b2)]
+        else:
+            order = [(self.t2, self.b2), (self.t1, self.b1)]
+        # The preferred list may only hold entries that are in use
+        for queue, ghosts in order:
+            obj = queue.get(block=False)
+            if obj is not None:
+                ghosts[self.keys[obj]] = None
+                if len(ghosts) > self.size:
+                    ghosts.popitem(last=False)
+                return obj
+
+POLICIES = {
+    'lru': LRUPolicy,
+    '2q': TwoQPolicy,
+    'arc': ARCPolicy,
+}
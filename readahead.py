@@ -0,0 +1,97 @@
+#!/usr/bin/python2
+
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger('gbd')
+
+class Stream:
+
+    def __init__(self, idx):
+        self.last = idx
+        self.seq = 0
+        self.window = 0
+        self.upto = idx
+        self.hits = 0
+        self.prefetched = set()
+
+class Readahead:
+
+    # A stream needs this many block-to-block steps before we prefetch
+    TRIGGER = 2
+    MIN_WINDOW = 4
+    MAX_STREAMS = 16
+
+    def __init__(self, block_count, max_window):
+        self.block_count = block_count
+        self.max_window = max_window
+        # last block read => stream, least recently continued first
+        self.streams = OrderedDict()
+        self.lock = Lock()
+
+    ## interface
+
+    def access(self, idxl, idxr, cached, budget):
+
+        with self.lock:
+
+            stream = self.streams.pop(idxl, None) or self.streams.pop(idxl - 1, None)
+            if stream is None:
+                stream = Stream(idxr)
+            else:
+                if idxl > stream.last:
+                    stream.seq += 1
+                self.consume(stream, idxl, idxr, cached)
+                stream.last = max(stream.last, idxr)
+
+            self.streams[stream.last] = stream
+            while len(self.streams) > self.MAX_STREAMS:
+                self.streams.popitem(last=False)
+
+            if stream.seq < self.TRIGGER:
+                return []
+            return self.advance(stream, budget)
+
+    ## helper
+
+    def consume(self, stream, idxl, idxr, cached):
+        for idx in xrange(idxl, idxr + 1):
+            if idx not in stream.prefetched:
+                continue
+            stream.prefetched.discard(idx)
+            if cached(idx):
+                stream.hits += 1
+            else:
+                # Evicted before the reader got there, we're running too far ahead
+                stream.window = max(self.MIN_WINDOW, stream.window // 2)
+                stream.hits = 0
+
+        # Prefetched blocks the reader jumped over were wasted
+        stale = [idx for idx in stream.prefetched if idx <= idxr]
+        if stale:
+            stream.prefetched.difference_update(stale)
+            stream.window = max(self.MIN_WINDOW, stream.window // 2)
+            stream.hits = 0
+
+    def advance(self, stream, budget):
+
+        if stream.window == 0:
+            stream.window = self.MIN_WINDOW
+        elif stream.hits >= stream.window // 2:
+            stream.window = min(self.max_window, stream.window * 2)
+            stream.hits = 0
+
+        # Never take more than half of what can still be evicted
+        window = min(stream.window, self.max_window, budget // 2)
+        if window <= 0:
+            return []
+
+        start = max(stream.upto, stream.last) + 1
+        end = min(self.block_count, stream.last + 1 + window)
+        todo = range(start, end)
+        if todo:
+            logger.debug("Readahead {0}-{1} (window {2})".format(start, end - 1, window))
+            stream.upto = end - 1
+            stream.prefetched.update(todo)
+        return todo
@@ -0,0 +1,100 @@
+#!/usr/bin/python2
+
+import logging
+from threading import Thread, Condition, Event
+from backend import RateLimitError
+
+logger = logging.getLogger('gbd')
+
+class SparePool(Thread):
+
+    # Empty block files created ahead of time, a batch per request, so the
+    # first write to a block only has to fill one in and rename it instead
+    # of uploading a new file. Spares left over at exit are picked up by the
+    # next run.
+
+    NAME = 'gbd_spare'
+    # Most files drive takes in one batch request
+    BATCH = 100
+    RETRY_DELAY = 10.0
+
+    def __init__(self, gbd, size):
+        Thread.__init__(self)
+        self.daemon = True
+        self.gbd = gbd
+        self.size = size
+        self.low = max(1, size // 2)
+        self.spares = []
+        self.cv = Condition()
+        self.started = False
+        self.stopped = Event()
+
+    ## interface
+
+    def claim(self):
+        # A spare block id, None if there is none right now
+        with self.cv:
+            if not self.started:
+                self.started = True
+                self.start()
+            blkid = self.spares.pop() if self.spares else None
+            if len(self.spares) < self.low:
+                self.cv.notify()
+            return blkid
+
+    def unclaim(self, blkid):
+        with self.cv:
+            self.spares.append(blkid)
+
+    def stop(self):
+        with self.cv:
+            self.stopped.set()
+            self.cv.notify()
+            started = self.started
+        if started:
+            self.join()
+
+    def __len__(self):
+        return len(self.spares)
+
+    def run(self):
+
+        backend = self.gbd.backend.clone()
+        try:
+            found = backend.find(self.NAME)
+        except Exception as e:
+            logger.warning("Can't list spare blocks: {0}".format(repr(e)))
+            found = []
+        if found:
+            logger.info("Found {0} spare blocks".format(len(found)))
+        with self.cv:
+            self.spares.extend(found)
+
+        while True:
+            with self.cv:
+                while len(self.spares) >= self.low and not self.stopped.is_set():
+                    self.cv.wait()
+                if self.stopped.is_set():
+                    return
+                count = min(self.BATCH, self.size - len(self.spares))
+            spares = self.allocate(backend, count)
+            with self.cv:
+                self.spares.extend(spares)
+
+    ## helper
+
+    def allocate(self, backend, count):
+        self.gbd.throttle.acquire()
+        throttled = False
+        try:
+            return backend.allocate_many(self.NAME, count)
+        except RateLimitError:
+            # The throttle holds the next batch back
+            throttled = True
+            return []
+        except Exception as e:
+            logger.warning("Can't allocate spare blocks: {0}".format(repr(e)))
+        finally:
+            self.gbd.throttle.release(throttled)
+        self.stopped.wait(self.RETRY_DELAY)
+        return []
@@ -0,0 +1,120 @@
+#!/usr/bin/python2
+
+import time
+import random
+import logging
+from collections import deque
+from threading import Condition
+
+logger = logging.getLogger('gbd')
+
+class Throttle:
+
+    # Shared by every worker of a GBD. Requests go out at most `rate` per
+    # second (a token bucket) and at most `limit` at a time. Both grow
+    # slowly while the store keeps up and shrink when it pushes back,
+    # which also pauses everyone for a while. Retries are paid for by the
+    # requests that went through, so a store that is down doesn't turn
+    # every request into five.
+
+    DECREASE = 0.7
+    # Share of the rate it grows by per second while it holds us back,
+    # at least a request per second
+    PROBE = 0.1
+    MIN_RATE = 0.5
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 32.0
+    # Seconds of completions the throughput is measured over
+    WINDOW = 5.0
+    RETRY_RATIO = 0.1
+    RETRY_BURST = 10.0
+
+    def __init__(self, max_inflight, rate=0):
+        self.max_inflight = max_inflight
+        self.limit = float(max_inflight)
+        self.inflight = 0
+        # No rate limit until the store asks for one
+        self.rate = float(rate) if rate > 0 else None
+        self.tokens = float(max_inflight)
+        self.last_refill = time.time()
+        self.backoff = 0.0
+        self.resume_at = 0.0
+        self.completions = deque()
+        self.started = time.time()
+        self.budget = self.RETRY_BURST
+        self.cv = Condition()
+
+    ## interface
+
+    def acquire(self, retry=False):
+        # Blocks until the request may go out, False if a retry is over budget
+        with self.cv:
+            if retry:
+                if self.budget < 1:
+                    return False
+                self.budget -= 1
+            else:
+                self.budget = min(self.RETRY_BURST, self.budget + self.RETRY_RATIO)
+            while True:
+                now = time.time()
+                self.refill(now)
+                if now < self.resume_at:
+                    self.cv.wait(self.resume_at - now)
+                elif self.inflight >= int(self.limit):
+                    self.cv.wait()
+                elif self.rate is not None and self.tokens < 1:
+                    self.cv.wait((1 - self.tokens) / self.rate)
+                else:
+                    break
+            self.inflight += 1
+            if self.rate is not None:
+                self.tokens -= 1
+            return True
+
+    def release(self, throttled=False):
+        with self.cv:
+            self.inflight -= 1
+            now = time.time()
+            if throttled:
+                self.decrease(now)
+            else:
+                self.increase(now)
+            self.cv.notify_all()
+
+    ## helper
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.limit, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def throughput(self, now):
+        while self.completions and self.completions[0] < now - self.WINDOW:
+            self.completions.popleft()
+        return len(self.completions) / max(1.0, min(self.WINDOW, now - self.started))
+
+    def decrease(self, now):
+        # Requests sent before we backed off come back throttled too, one
+        # decrease per backoff period is enough
+        if now < self.resume_at + self.backoff:
+            return
+        recent = max(self.throughput(now), self.MIN_RATE)
+        self.rate = max(self.MIN_RATE, min(self.rate or recent, recent) * self.DECREASE)
+        self.limit = max(1.0, self.limit * self.DECREASE)
+        self.tokens = min(self.tokens, 1.0)
+        self.backoff = min(self.MAX_BACKOFF, max(self.MIN_BACKOFF, self.backoff * 2))
+        self.resume_at = now + random.uniform(0.5, 1.0) * self.backoff
+        logger.warning("Store is throttling us, down to {0:.1f} requests/s and {1} at a time for {2:.1f}s".format(
+            self.rate, int(self.limit), self.resume_at - now))
+
+    def increase(self, now):
+        self.completions.append(now)
+        if now >= self.resume_at + self.backoff:
+            self.backoff = 0.0
+        # Only probe while the limit is what holds us back, or a quiet
+        # spell lets it run away and the next burst hits the store at full
+        # speed
+        if self.inflight + 1 >= int(self.limit):
+            self.limit = min(float(self.max_inflight), self.limit + 1.0 / self.limit)
+        if self.rate is not None and self.tokens < 1:
+            self.rate += max(1.0, self.PROBE * self.rate) / self.rate
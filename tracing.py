@@ -0,0 +1,160 @@
+#!/usr/bin/python2
+
+import os
+import json
+import time
+import random
+import itertools
+import logging
+from threading import Lock
+
+logger = logging.getLogger('gbd')
+
+class Trace:
+
+    # One sampled request. Every block it touches gets its own lane of
+    # stages, a stage lasts until the next mark in the same lane and the
+    # last mark of a block is when its part of the request was served.
+
+    def __init__(self, tracer, id, name, args):
+        self.tracer = tracer
+        self.id = id
+        self.name = name
+        self.args = args
+        self.start = time.time()
+        self.marks = []
+
+    ## interface
+
+    def mark(self, stage, lane=None):
+        # Called from any thread, list.append doesn't need a lock
+        self.marks.append((lane, stage, time.time()))
+
+    def finish(self):
+        self.tracer.record(self, time.time())
+
+class Tracer:
+
+    def __init__(self):
+        self.rate = 0.0
+        self.fout = None
+        self.first = True
+        self.serial = itertools.count(1)
+        self.pid = os.getpid()
+        self.lock = Lock()
+
+    ## interface
+
+    def open(self, path, rate=1.0):
+        # Written as it goes, chrome://tracing and perfetto take the event
+        # array without the closing bracket if we never get to close it
+        with self.lock:
+            self.fout = open(path, 'w')
+            self.fout.write('[\n')
+            self.first = True
+            self.rate = rate
+        logger.info("Tracing {0:.1%} of the requests to `{1}'".format(rate, path))
+
+    def start(self, name, **args):
+        if self.rate <= 0 or (self.rate < 1 and random.random() >= self.rate):
+            return None
+        return Trace(self, next(self.serial), name, args)
+
+    def record(self, trace, end):
+
+        events = [self.event(trace, 'b', trace.name, trace.start, 'request', trace.args)]
+        lanes = {}
+        for lane, stage, ts in trace.marks:
+            lanes.setdefault(lane, []).append((ts, stage))
+        for lane, marks in sorted(lanes.items()):
+            marks.sort()
+            if lane is None:
+                marks.append((end, None))
+            args = {} if lane is None else {'block': lane}
+            for (ts, stage), (next_ts, _) in zip(marks, marks[1:]):
+                events.append(self.event(trace, 'b', stage, ts, 'stage', args))
+                events.append(self.event(trace, 'e', stage, next_ts, 'stage', args))
+            if lane is not None:
+                ts, stage = marks[-1]
+                events.append(self.event(trace, 'n', stage, ts, 'stage', args))
+        events.append(self.event(trace, 'e', trace.name, end, 'request', trace.args))
+
+        with self.lock:
+            if self.fout is None:
+                return
+            for event in events:
+                self.fout.write(('' if self.first else ',\n') + json.dumps(event))
+                self.first = False
+            self.fout.flush()
+
+    def close(self):
+        with self.lock:
+            self.rate = 0.0
+            if self.fout is not None:
+                self.fout.write('\n]\n')
+                self.fout.close()
+                self.fout = None
+
+    ## helper
+
+    def event(self, trace, ph, name, ts, cat, args):
+        return {
+            'name': name,
+            'cat': cat,
+            'ph': ph,
+            'id': trace.id,
+            'ts': ts * 1e6,
+            'pid': self.pid,
+            'tid': trace.id,
+            'args': args,
+        }
+
+class TracedBackend:
+
+    # Wraps a worker's backend while it serves a sampled request, so the
+    # time spent in the store shows apart from the layout around it
+
+    def __init__(self, backend, trace, lane):
+        self.backend = backend
+        self.trace = trace
+        self.lane = lane
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kargs):
+            self.trace.mark('store.' + name, self.lane)
+            try:
+                return attr(*args, **kargs)
+            finally:
+                self.trace.mark('layout', self.lane)
+        return call
+
+class RequestRecorder:
+
+    # Saves nbd requests as they come off the wire, header and write
+    # payload, which is what bench.py --replay reads back
+
+    def __init__(self, path):
+        self.fout = open(path, 'ab')
+        self.lock = Lock()
+        logger.info("Recording nbd requests to `{0}'".format(path))
+
+    ## interface
+
+    def record(self, header, data=None):
+        with self.lock:
+            if self.fout is None:
+                return
+            self.fout.write(header)
+            if data is not None:
+                self.fout.write(data)
+
+    def close(self):
+        with self.lock:
+            if self.fout is not None:
+                self.fout.close()
+                self.fout = None
+
+TRACER = Tracer()
@@ -1,24 +1,108 @@
 #!/usr/bin/python2
 
 import time
-from Queue import PriorityQueue
-from threading import Condition
-
-class TimedPriorityQueue(PriorityQueue):
+import itertools
+from collections import deque
+from threading import Condition, local
+
+class DeadlineQueue:
+
+    # Each priority has its own FIFO, and an item is due DEADLINES[pri]
+    # seconds after it was queued. Overdue items go first, earliest
+    # deadline first, so low priority work waits but never starves;
+    # otherwise the highest priority goes first. With `reserved` set, at
+    # most `workers - reserved` consumers work on PRI_BACKGROUND items at a
+    # time, the rest are kept for requests someone is waiting for.
+    #
+    # Deadlines count from the clock as last read by get(), which is close
+    # enough while consumers keep taking items. An empty queue may have
+    # gone unread for a long time, so put() reads the clock when it fills
+    # it. Ties go by arrival.
 
     PRI_HIGH = -1
     PRI_NORMAL = 0
     PRI_LOW = 1
+    PRI_BACKGROUND = 2
+
+    DEADLINES = {
+        PRI_HIGH: 0.0,
+        PRI_NORMAL: 0.1,
+        PRI_LOW: 0.5,
+        PRI_BACKGROUND: 2.0,
+    }
+
+    def __init__(self, workers=None, reserved=0):
+        self.queues = dict((pri, deque()) for pri in sorted(self.DEADLINES))
+        self.seq = itertools.count()
+        self.now = time.time()
+        self.count = 0
+        self.unfinished = 0
+        self.background = 0
+        self.max_background = max(1, workers - reserved) if workers is not None else None
+        # Consumer thread => whether its current item is background work
+        self.local = local()
+        self.cv = Condition()
 
-    def __init__(self, *args, **kargs):
-        PriorityQueue.__init__(self, *args, **kargs)
+    ## interface
 
     def put(self, item, priority=PRI_NORMAL):
-        PriorityQueue.put(self, (priority, time.time(), item))
+        with self.cv:
+            if not self.count:
+                self.now = time.time()
+            self.queues[priority].append((self.now + self.DEADLINES[priority], next(self.seq), item))
+            self.count += 1
+            self.unfinished += 1
+            self.cv.notify()
+
+    def get(self):
+        with self.cv:
+            while True:
+                pri = self.pick()
+                if pri is not None:
+                    break
+                self.cv.wait()
+            _, _, item = self.queues[pri].popleft()
+            self.count -= 1
+            if self.max_background is not None:
+                self.local.background = pri == self.PRI_BACKGROUND
+                if self.local.background:
+                    self.background += 1
+            return item
+
+    def task_done(self):
+        with self.cv:
+            if getattr(self.local, 'background', False):
+                self.local.background = False
+                self.background -= 1
+            self.unfinished -= 1
+            self.cv.notify_all()
+
+    def join(self):
+        with self.cv:
+            while self.unfinished:
+                self.cv.wait()
+
+    def qsize(self):
+        return self.count
 
-    def get(self, *args, **kargs):
-        _, _, item = PriorityQueue.get(self, *args, **kargs)
-        return item
+    ## helper
+
+    def pick(self):
+        # Priority of the queue to take from, None if nothing can go now
+        heads = []
+        for pri, queue in self.queues.iteritems():
+            if not queue:
+                continue
+            if pri == self.PRI_BACKGROUND and self.max_background is not None and self.background >= self.max_background:
+                continue
+            heads.append((queue[0][:2], pri))
+        if not heads:
+            return None
+        self.now = time.time()
+        overdue = [head for head in heads if head[0][0] <= self.now]
+        if overdue:
+            return min(overdue)[1]
+        return min(heads, key=lambda head: head[1])[1]
 
 class RLUQueue:
 
@@ -28,6 +112,8 @@ class RLUQueue:
         self.next = [None] * size
         self.prev.append(size)
         self.next.append(size)
+        self.count = 0
+        self.closed = False
         self.cv = Condition()
 
     ## interface
@@ -42,21 +128,43 @@ class RLUQueue:
         self.cv.release()
 
     def get(self, block=True):
+        # None once closed
         self.cv.acquire()
         if not block and self._empty():
             self.cv.release()
             return None
-        while self._empty():
+        while self._empty() and not self.closed:
             self.cv.wait()
-        ret = self.remove(self.next[-1])
+        ret = None if self.closed else self.remove(self.next[-1])
         self.cv.release()
         return ret
 
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
+    def extend(self, idxs):
+        # Bulk append of idxs that aren't queued yet
+        idxs = list(idxs)
+        with self.cv:
+            if not idxs:
+                return
+            chain = [self.prev[-1]] + idxs + [self.size]
+            for prev, idx, next in itertools.izip(chain, idxs, chain[2:]):
+                self.prev[idx] = prev
+                self.next[idx] = next
+            self.next[chain[0]] = idxs[0]
+            self.prev[-1] = idxs[-1]
+            self.count += len(idxs)
+            self.cv.notify_all()
+
     def unget(self, idx):
         assert 0 <= idx < self.size
         with self.cv:
             assert not self.in_list(idx)
             self.prepend(idx)
+            self.cv.notify()
 
     def pop(self, idx):
         assert 0 <= idx < self.size
@@ -66,6 +174,9 @@ class RLUQueue:
     def empty(self):
         with self.cv:
             return self._empty()
+
+    def __len__(self):
+        return self.count
     
     ## helper
 
@@ -80,6 +191,7 @@ class RLUQueue:
         self.prev[self.next[idx]] = self.prev[idx]
         self.prev[idx] = None
         self.next[idx] = None
+        self.count -= 1
         return idx
 
     def append(self, idx):
@@ -87,10 +199,11 @@ class RLUQueue:
         self.prev[idx] = self.prev[-1]
         self.prev[self.next[idx]] = idx
         self.next[self.prev[idx]] = idx
+        self.count += 1
 
     def prepend(self, idx):
         self.next[idx] = self.next[-1]
         self.prev[idx] = self.size
         self.prev[self.next[idx]] = idx
         self.next[self.prev[idx]] = idx
-
+        self.count += 1